@@ -8,26 +8,74 @@ from PIL import ImageDraw
 from PIL import ImageFont
 from PIL import ImageEnhance
 from PIL import ImageColor
+from PIL import ImageChops
+from PIL import features
 import math
 import os
-from matplotlib.path import Path as PlotPath
 import numpy as np
-from sklearn.cluster import KMeans
 import cv2
-from collections import Counter
+from collections import OrderedDict
 import random
-import uuid
 from pathlib import Path
 import resources
 import json
 import base64
 from io import BytesIO
 import shutil
+import zipfile
+import zlib
+import struct
+import hashlib
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 # Set the path to the temporary subdirectory used to store
 # original and edited layer images.
 project_path = Path("project/")
 
+# Number of colours in a layer's palette
+palette_size = 7
+
+# Largest width or height of the layer previews stored in projects,
+# WebP keeps them small when Pillow supports it.
+preview_size = 512
+preview_format = "WEBP" if features.check("webp") else "PNG"
+
+# The project is autosaved every autosave_interval milliseconds into
+# the next of autosave_slots project files. Autosaves are kept in their
+# own folder as the project folder is cleared when the app starts.
+autosave_path = Path("autosave/")
+autosave_interval = 2 * 60 * 1000
+autosave_slots = 3
+
+# Decoded project images can be cached on disk between sessions so
+# that reopening a project maps them rather than decoding them again.
+# The cache is off unless pixel_cache_limit is set to its size in
+# bytes. The least recently used files are removed when the app starts
+# and after every pixel_cache_evict_stores images stored.
+pixel_cache_path = Path.home() / ".cache" / "digital-collage-creator"
+pixel_cache_limit = 0
+pixel_cache_evict_stores = 16
+
+# Exported images are rendered and written export_strip_rows rows at a
+# time, so exports larger than the canvas need little memory.
+export_strip_rows = 256
+
+# The prepared pixels of each layer, premultiplied and reduced, are
+# kept for all the strips of an exported image while they take at most
+# export_cache_limit bytes. Layers over the limit are prepared again
+# for each strip from the part of them under it.
+export_cache_limit = 256 * 1024 * 1024
+
+# Formats the canvas can be saved as, by their save dialog filter
+image_formats = {"PNG Images (*.png)": ("PNG", ".png"),
+                 "TIFF Images (*.tif)": ("TIFF", ".tif"),
+                 "JPEG Images (*.jpg)": ("JPEG", ".jpg")}
+if features.check("webp"):
+    image_formats["WebP Images (*.webp)"] = ("WEBP", ".webp")
+
 # Action Manager
 
 
@@ -35,6 +83,7 @@ class AMTokens():
     # Defines a list of action tokens used to describe and identify
     # the function of an action.
     layer_added_token = "LYRADD"
+    layers_added_token = "LYRSADD"
     layer_deleted_token = "LYRDLT"
     layer_moved_token = "LYRMOV"
     layer_rotated_token = "LYRROT"
@@ -47,6 +96,7 @@ class AMTokens():
     sharpness_token = "LYRSHRP"
     contrast_token = "LYRCON"
     rgb_token = "LYRRGB"
+    colour_match_token = "LYRMCH"
     layer_moved_down_token = "LYRDWN"
     layer_moved_up_token = "LYRUP"
     active_layer_change_token = "ACTLYR"
@@ -93,6 +143,13 @@ class ActionManager():
         ActionManager.action()
         ActionManager.action_stack.append([AMTokens.layer_added_token, layer])
 
+    def layersAdded(layers):
+        # Layers added together, such as the layers of an opened
+        # project, are undone as one action.
+        ActionManager.action()
+        ActionManager.action_stack.append(
+            [AMTokens.layers_added_token, layers])
+
     def layerDeleted(layer):
         ActionManager.action()
         ActionManager.action_stack.append(
@@ -113,15 +170,17 @@ class ActionManager():
         ActionManager.action_stack.append(
             [AMTokens.layer_scaled_token, layer, orig_scale, new_scale])
 
-    def layerCut(layer, orig_image, new_image):
+    def layerCut(layer, orig_mask, new_mask):
         ActionManager.action()
         ActionManager.action_stack.append(
-            [AMTokens.layer_cut_token, layer, orig_image, new_image])
+            [AMTokens.layer_cut_token, layer, orig_mask, new_mask])
 
-    def layerCropped(layer, orig_image, new_image, coordinates):
+    def layerCropped(layer, orig_image, new_image, coordinates, orig_mask, new_mask,
+                     orig_rotation, orig_scale):
         ActionManager.action()
         ActionManager.action_stack.append(
-            [AMTokens.layer_cropped_token, layer, orig_image, new_image, coordinates])
+            [AMTokens.layer_cropped_token, layer, orig_image, new_image, coordinates,
+             orig_mask, new_mask, orig_rotation, orig_scale])
 
     def blurChanged(layer, orig_blur, new_blur):
         ActionManager.action()
@@ -153,6 +212,12 @@ class ActionManager():
         ActionManager.action_stack.append(
             [AMTokens.rgb_token, layer, orig_rgb, new_rgb])
 
+    def colourMatchChanged(layers, orig_matches, new_matches):
+        # One action holds every layer changed by a colour match
+        ActionManager.action()
+        ActionManager.action_stack.append(
+            [AMTokens.colour_match_token, layers, orig_matches, new_matches])
+
     def layerMovedDown(layer):
         ActionManager.action()
         ActionManager.action_stack.append(
@@ -368,6 +433,20 @@ class ActionManager():
         layer.applyAlterations()
         ActionManager.action_stack.append(action)
 
+    # Functions to undo and redo the colour matching of one or
+    # more layers.
+    def undoColourMatchChange(action):
+        for layer, orig_match in zip(action[1], action[2]):
+            layer.setColourMatch(orig_match)
+            layer.applyAlterations()
+        ActionManager.removed_actions.append(action)
+
+    def redoColourMatchChange(action):
+        for layer, new_match in zip(action[1], action[3]):
+            layer.setColourMatch(new_match)
+            layer.applyAlterations()
+        ActionManager.action_stack.append(action)
+
     # Functions to undo and redo the application/removal
     # of the blur filter on a layer.
     def undoBlurChange(action):
@@ -384,17 +463,22 @@ class ActionManager():
         layer.applyAlterations()
         ActionManager.action_stack.append(action)
 
-    # Functions to undo and redo the cropping of an image.
+    # Functions to undo and redo the cropping of an image. Undoing a
+    # crop puts back the image and mask from before the crop with the
+    # rotation and scale they were shown at, so the masks of earlier
+    # cuts still match the image.
     def undoLayerCrop(action):
         layer = action[1]
         orig_image = action[2]
         coordinates = action[4]
         orig_x, orig_y = coordinates[0], coordinates[1]
-        cropped_image_name = layer.cropped_image_name
-        orig_image.save(str(project_path / cropped_image_name))
-        layer.setXY(orig_x, orig_y)
-        setOriginToCenter(layer.getLayerItem())
+        layer.setCroppedImage(orig_image)
+        layer.setMask(action[5])
         layer.applyAlterations()
+        setOriginToCenter(layer.getLayerItem())
+        layer.getLayerItem().setRotation(action[7])
+        layer.getLayerItem().setScale(action[8])
+        layer.setXY(orig_x, orig_y)
         ActionManager.removed_actions.append(action)
 
     def redoLayerCrop(action):
@@ -402,29 +486,40 @@ class ActionManager():
         new_image = action[3]
         coordinates = action[4]
         new_x, new_y = coordinates[2], coordinates[3]
-        cropped_image_name = layer.cropped_image_name
-        new_image.save(str(project_path / cropped_image_name))
+        layer.setCroppedImage(new_image)
+        layer.setMask(action[6])
+        layer.getLayerItem().setRotation(0)
+        layer.getLayerItem().setScale(1)
         layer.setXY(new_x, new_y)
         layer.applyAlterations()
+        setOriginToCenter(layer.getLayerItem())
         ActionManager.action_stack.append(action)
 
-    # Functions to undo and redo the cutting of an image.
+    # Functions to undo and redo the cutting of an image. Cuts only
+    # change the layer's mask so the alterations are not reapplied.
     def undoLayerCut(action):
         layer = action[1]
-        orig_image = action[2]
-        cropped_image_name = layer.cropped_image_name
-        orig_image.save(str(project_path / cropped_image_name))
-        layer.applyAlterations()
+        orig_mask = action[2]
+        layer.setMask(ActionManager.fitMask(layer, orig_mask))
+        layer.compositeMask()
         ActionManager.removed_actions.append(action)
 
     def redoLayerCut(action):
         layer = action[1]
-        new_image = action[3]
-        cropped_image_name = layer.cropped_image_name
-        new_image.save(str(project_path / cropped_image_name))
-        layer.applyAlterations()
+        new_mask = action[3]
+        layer.setMask(ActionManager.fitMask(layer, new_mask))
+        layer.compositeMask()
         ActionManager.action_stack.append(action)
 
+    def fitMask(layer, mask):
+        # A mask is the size of the image it was cut from. Should the
+        # layer image have another size when a cut is undone or redone
+        # the mask is scaled to it rather than failing to combine.
+        size = layer.getCroppedImage().size
+        if mask is not None and mask.size != size:
+            mask = mask.resize(size, Image.BILINEAR)
+        return mask
+
     # Functions to undo and redo changes made to a layer's size.
     def undoLayerScaled(action):
         layer = action[1]
@@ -477,6 +572,16 @@ class ActionManager():
         LayerManager.undoDeleteLayer(action[1])
         ActionManager.action_stack.append(action)
 
+    def undoLayersAdded(action):
+        for layer in reversed(action[1]):
+            mw.deleteLayer(layer)
+        ActionManager.removed_actions.append(action)
+
+    def redoLayersAdded(action):
+        for layer in action[1]:
+            LayerManager.undoDeleteLayer(layer)
+        ActionManager.action_stack.append(action)
+
     # Functions to undo and redo the deletion of a layer.
     def undoLayerDeleted(action):
         LayerManager.undoDeleteLayer(action[1])
@@ -512,6 +617,8 @@ class ActionManager():
         action_to_undo = action
         if (action_to_undo[0] == AMTokens.layer_added_token):
             ActionManager.undoLayerAdded(action_to_undo)
+        elif (action_to_undo[0] == AMTokens.layers_added_token):
+            ActionManager.undoLayersAdded(action_to_undo)
         elif (action_to_undo[0] == AMTokens.layer_deleted_token):
             ActionManager.undoLayerDeleted(action_to_undo)
         elif (action_to_undo[0] == AMTokens.layer_moved_token):
@@ -532,6 +639,8 @@ class ActionManager():
             ActionManager.undoBrightnessChange(action_to_undo)
         elif (action_to_undo[0] == AMTokens.contrast_token):
             ActionManager.undoContrastChange(action_to_undo)
+        elif (action_to_undo[0] == AMTokens.colour_match_token):
+            ActionManager.undoColourMatchChange(action_to_undo)
         elif (action_to_undo[0] == AMTokens.sharpness_token):
             ActionManager.undoSharpnessChange(action_to_undo)
         elif (action_to_undo[0] == AMTokens.rgb_token):
@@ -576,6 +685,8 @@ class ActionManager():
         action_to_redo = action
         if (action_to_redo[0] == AMTokens.layer_added_token):
             ActionManager.redoLayerAdded(action_to_redo)
+        elif (action_to_redo[0] == AMTokens.layers_added_token):
+            ActionManager.redoLayersAdded(action_to_redo)
         elif (action_to_redo[0] == AMTokens.layer_deleted_token):
             ActionManager.redoLayerDeleted(action_to_redo)
         elif (action_to_redo[0] == AMTokens.layer_moved_token):
@@ -596,6 +707,8 @@ class ActionManager():
             ActionManager.redoBrightnessChange(action_to_redo)
         elif (action_to_redo[0] == AMTokens.contrast_token):
             ActionManager.redoContrastChange(action_to_redo)
+        elif (action_to_redo[0] == AMTokens.colour_match_token):
+            ActionManager.redoColourMatchChange(action_to_redo)
         elif (action_to_redo[0] == AMTokens.sharpness_token):
             ActionManager.redoSharpnessChange(action_to_redo)
         elif (action_to_redo[0] == AMTokens.rgb_token):
@@ -617,6 +730,91 @@ class ActionManager():
         ActionManager.removed_actions = []
 
 
+class TaskCancelled(Exception):
+    # Raised inside a background task function when the task has been
+    # cancelled so the remaining work is skipped.
+    pass
+
+
+class TaskSignals(qtc.QObject):
+    # QRunnable is not a QObject so the signals used to report the
+    # state of a background task are held by a separate object.
+    progress = qtc.pyqtSignal(int)
+    finished = qtc.pyqtSignal(object)
+    failed = qtc.pyqtSignal(str)
+    cancelled = qtc.pyqtSignal()
+
+
+class BackgroundTask(qtc.QRunnable):
+    # Runs a function on a thread pool so that long running pixel work
+    # does not block the interface. The function receives
+    # the task as its first argument so that it can report progress and
+    # check whether the user has cancelled the work. Results are passed
+    # back to the interface thread through the task's signals.
+
+    # Python references to running tasks are kept so that the signal
+    # objects are not garbage collected before they are emitted.
+    running = set()
+    # Qt uses the global thread pool for some of its own image work
+    # and blocks the interface thread until it is done, so the tasks
+    # use a separate pool to avoid waiting on each other.
+    pool = None
+
+    def threadPool():
+        if BackgroundTask.pool is None:
+            BackgroundTask.pool = qtc.QThreadPool()
+        return BackgroundTask.pool
+
+    def cancelAll():
+        # Cancel the running tasks and wait for them to stop, called
+        # when the application closes.
+        for task in list(BackgroundTask.running):
+            task.cancel()
+        BackgroundTask.threadPool().waitForDone()
+
+    def __init__(self, function, *args):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.signals = TaskSignals()
+        self.is_cancelled = False
+
+    def start(self, priority=0):
+        BackgroundTask.running.add(self)
+        self.signals.finished.connect(self.release)
+        self.signals.failed.connect(self.release)
+        self.signals.cancelled.connect(self.release)
+        BackgroundTask.threadPool().start(self, priority)
+
+    def release(self, *args):
+        BackgroundTask.running.discard(self)
+
+    def cancel(self):
+        self.is_cancelled = True
+
+    def checkCancelled(self):
+        # Called by the task function between units of work.
+        if self.is_cancelled:
+            raise TaskCancelled()
+
+    def setProgress(self, percent):
+        self.signals.progress.emit(int(percent))
+
+    def run(self):
+        try:
+            result = self.function(self, *self.args)
+        except TaskCancelled:
+            self.signals.cancelled.emit()
+            return
+        except Exception as error:
+            self.signals.failed.emit(str(error))
+            return
+        if self.is_cancelled:
+            self.signals.cancelled.emit()
+        else:
+            self.signals.finished.emit(result)
+
+
 class ImagePoint:
 
     def __init__(self, x, y):
@@ -679,11 +877,17 @@ class LineManager:
 
 class PointManager():
     # Manages the points plotted by the user when drawing the path
-    # over an image in the cutout window.
+    # over an image in the cutout window. A cutout can be made of
+    # several closed sub-paths, the points of the path currently being
+    # plotted are kept in points and finished paths in closed_paths.
 
     def __init__(self, cw):
         self.cw = cw
         self.points = []
+        self.closed_paths = []
+        # Undone points are kept as (point, sub-path index, closed)
+        # where closed marks the last point of a closed sub-path, so
+        # that redoing it closes the sub-path again.
         self.removed = []
         self.redo_flag = False
 
@@ -721,16 +925,25 @@ class PointManager():
         self.line_manager.emptyStack()
 
     def undo(self):
+        closed = False
+        if not self.points and self.closed_paths:
+            # Reopen the most recently closed sub-path.
+            self.points = self.closed_paths.pop()
+            closed = True
+
         if self.points:
             # Take the most recently added point and push it onto
             # the stack of removed points.
             self.point_to_remove = self.points.pop()
-            self.removed.append(self.point_to_remove)
+            self.removed.append(
+                (self.point_to_remove, len(self.closed_paths), closed))
 
             # Remove the point marker image from the canvas and
             # call line manager to remove the most recently drawn line.
+            # The first point of a path has no line leading to it.
             self.cw.graphics_scene.removeItem(self.point_to_remove.point_item)
-            self.line_manager.removeLine()
+            if self.points:
+                self.line_manager.removeLine()
 
             mw.status_bar.showMessage("Point undone...", 4000)
         else:
@@ -741,9 +954,13 @@ class PointManager():
         if self.removed:
             # Take the most recently deleted point's coordinates (x,y)
             # and add a new point at (x,y)
-            self.point_to_add = self.removed.pop()
+            self.point_to_add, path_index, closed = self.removed.pop()
             self.redo_flag = True
             self.addPoint(self.point_to_add.x, self.point_to_add.y)
+            if closed and path_index == len(self.closed_paths):
+                # The point closed its sub-path, close it again
+                self.closed_paths.append(self.points)
+                self.points = []
             mw.status_bar.showMessage("Point redone...", 4000)
         else:
             # The list of removed points is empty.
@@ -763,81 +980,101 @@ class PointManager():
             self.addPoint(self.first_point.x, self.first_point.y)
             mw.status_bar.showMessage("Mask joined...", 4000)
 
+    def closePath(self):
+        # Joins the current path and starts a new sub-path, allowing
+        # holes and separate islands to be cut out together.
+        if len(self.points) < 3:
+            mw.status_bar.showMessage(
+                "A path needs at least 3 points...", 4000)
+            return
+        self.joinMask()
+        self.closed_paths.append(self.points)
+        self.points = []
+        self.emptyStack()
+        mw.status_bar.showMessage("Path closed, plot the next path...", 4000)
+
     def removeAllPoints(self):
         self.removed = []
-        while self.points:
-            self.point_to_remove = self.points.pop()
-            self.cw.graphics_scene.removeItem(self.point_to_remove.point_item)
+        for path in self.closed_paths + [self.points]:
+            while path:
+                self.point_to_remove = path.pop()
+                self.cw.graphics_scene.removeItem(
+                    self.point_to_remove.point_item)
+        self.closed_paths = []
 
     def maskClicked(self, blurAmount):
         # Called when the user clicks the "mask" option button.
         # Calls the image masking functions only if the user has
         # plotted points in the path.
-        if self.points:
+        if self.getSubPaths():
             self.maskImageWithBlur(blurAmount)
 
     def maskImageWithBlur(self, blurAmount):
-        cropped_image_name = self.cw.cropped_image_name
-        img = Image.open(str(project_path / cropped_image_name))
-        pre_cut_image = img.copy()
-        pre_cut_image.load()
-
-        # Create an array of all plotted point coordinates [x, y]
-        path_points = []
-        for point in self.points:
-            path_points.append([point.x, point.y])
-
-        # Use matplotlib to create a path from the set of points.
-        path = PlotPath(path_points)
-
-        # Create a grid the same size as the image
-        x, y = np.mgrid[:img.size[0], :img.size[1]]
-        # Turn the grid into an array of points
-        points = np.vstack((x.ravel(), y.ravel())).T
-
-        # Create a boolean array of true/false values
-        # True values are within the path, false outside the path.
-        mask = path.contains_points(points)
-        #path_points = points[np.where(mask)]
-
-        # Create an image of the filled mask
-        img_mask = mask.reshape(x.shape).T
+        img = self.cw.image_layer.getCroppedImage()
+
+        # Fill every sub-path into one boolean array in a single pass.
+        # True values are within the cutout, false outside it.
+        img_mask = rasterizePaths(self.getSubPaths(), img.size[0], img.size[1],
+                                  self.cw.getFillRule())
+        self.applyMask(img_mask, blurAmount)
+
+    def getSubPaths(self):
+        # Returns each plotted path with at least 3 points as
+        # a list of (x, y) coordinates.
+        return [[(point.x, point.y) for point in path]
+                for path in self.closed_paths + [self.points] if len(path) >= 3]
+
+    def applyMask(self, img_mask, blurAmount):
+        # Cuts the layer image using a boolean array the same size as
+        # the image, True values are kept. Used by both the plotted path
+        # and the automatic cutout so that each produces one undoable
+        # cut action. The cut is stored in the layer's mask, the layer
+        # image itself is not changed.
+        layer = self.cw.image_layer
         mask_image = Image.fromarray(img_mask)
-        mask_image = mask_image.convert("RGB")
-        mask_image.save("mask.png")
-
-        # Apply a blur filter to the mask image
-        blur = mask_image.copy()
-        blur = blur.filter(ImageFilter.GaussianBlur(blurAmount))
-        blur = blur.convert("L")
-        blur.save("blurMask.png")
-
-        # Apply the blurred mask to the image
-        new_image = img.copy().convert("RGBA")
-        new_image.putalpha(blur)
-
-        # Create an opaque blank image the same size as the original image
-        img = img.convert("RGBA")
-        masked_image = Image.new("RGBA", img.size, color=(0, 0, 0, 0))
-        # Paste the masked image into the blank image
-        # Use the original image as another mask to retain transparent sections
-        masked_image.paste(new_image, mask=img)
-        masked_image.save("masked.png")
-
-        # Save the cutout image
-        new_image = qtg.QPixmap("masked.png")
-        new_image.save(str(project_path / cropped_image_name))
-        self.cw.active_image_item.setPixmap(new_image)
-
-        post_cut_image = Image.open(str(project_path / cropped_image_name))
-        post_cut_image.load()
-        ActionManager.layerCut(self.cw.image_layer,
-                               pre_cut_image, post_cut_image)
-
-        self.cw.image_layer.applyAlterations()
+        mask_image = mask_image.convert("L")
+
+        # Apply a blur filter to the mask image to soften the edges
+        blur = mask_image.filter(ImageFilter.GaussianBlur(blurAmount))
+
+        # Combine the new cut with any previous cuts so that
+        # sections which are already transparent are retained.
+        pre_cut_mask = layer.getMask()
+        if pre_cut_mask is not None:
+            post_cut_mask = ImageChops.multiply(pre_cut_mask, blur)
+        else:
+            post_cut_mask = blur
+
+        # Only the mask is recombined with the altered layer image
+        layer.setMask(post_cut_mask)
+        layer.compositeMask()
+        self.cw.updateImage(convertImageToPixmap(layer.getMaskedImage()))
+
+        ActionManager.layerCut(layer, pre_cut_mask, post_cut_mask)
 
     def smoothEdges(self):
-        self.all_points = self.points
+        # Smooth every sub-path and plot them again.
+        paths = self.closed_paths + [self.points]
+        smooth_paths = [self.smoothPath(path) for path in paths if path]
+
+        # Remove all lines and points
+        self.line_manager.removeAllLines()
+        self.removeAllPoints()
+
+        for i, smooth_path in enumerate(smooth_paths):
+            # Add the new set of points
+            for smooth_point in smooth_path:
+                self.addPoint(smooth_point[0], smooth_point[1])
+
+            # Join the last point to the first point
+            if i < len(smooth_paths) - 1:
+                self.closePath()
+            else:
+                self.joinMask()
+
+    def smoothPath(self, path):
+        # Returns the coordinates of a curved version of the path.
+        self.all_points = path
 
         # Create a list called point_pairs which takes the plotted points
         # points[0], points[1], points[2], points[3] ... points[n]
@@ -853,10 +1090,6 @@ class PointManager():
                 pair.append(image_point)
             self.point_pairs.append(pair)
 
-        # Remove all lines and points
-        self.line_manager.removeAllLines()
-        self.removeAllPoints()
-
         self.smooth_points = []
         self.counter = 0
         t_range = np.linspace(0, 1, 10)
@@ -879,12 +1112,7 @@ class PointManager():
                                                            t * zipped_point[1].y) + ((t ** 2) * zipped_point[2].y)
                 self.smooth_points.append((round(px), round(py)))
 
-        # Add the new set of points
-        for smooth_point in self.smooth_points:
-            self.addPoint(smooth_point[0], smooth_point[1])
-
-        # Join the last point to the first point
-        self.joinMask()
+        return self.smooth_points
 
 
 class CutoutGraphicsView(qtw.QGraphicsView):
@@ -905,11 +1133,61 @@ class CutoutGraphicsView(qtw.QGraphicsView):
             self.updateView()
 
     def mouseMoveEvent(self, event):
+        # Pass the event on to the scene so a seed box can be drawn.
+        super().mouseMoveEvent(event)
         scene_pos = self.mapToScene(event.pos())
         # Update the visible scene in the zoomed in view
         self.cw.mini_view.setView(scene_pos.x(), scene_pos.y(), self.cw)
         # Update the cursor indicator position in the zoomed in view
-        self.cw.indicator_pixmap_item.setPos(scene_pos.x()*2, scene_pos.y()*2)
+        zoom = self.cw.magnifier_zoom
+        self.cw.indicator_pixmap_item.setPos(
+            scene_pos.x()*zoom, scene_pos.y()*zoom)
+
+
+class MagnifierTileCache():
+    # Stores zoomed in tiles of the cutout image for the magnifier.
+    # Each tile is a square region of the image scaled up by the zoom
+    # factor. Tiles are only created when the cursor first moves near
+    # them and the least recently used tiles are discarded once the
+    # cache is full, so the full size image is never resampled.
+
+    def __init__(self, pixmap, zoom, tile_size=64, max_tiles=64):
+        self.pixmap = pixmap
+        self.zoom = zoom
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.tiles = OrderedDict()
+
+    def getTile(self, tile_x, tile_y):
+        key = (tile_x, tile_y)
+        if key in self.tiles:
+            # Mark the tile as the most recently used.
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+
+        source_rect = qtc.QRect(tile_x * self.tile_size, tile_y * self.tile_size,
+                                self.tile_size, self.tile_size).intersected(self.pixmap.rect())
+        tile = self.pixmap.copy(source_rect).scaled(
+            source_rect.width() * self.zoom, source_rect.height() * self.zoom,
+            qtc.Qt.IgnoreAspectRatio, qtc.Qt.FastTransformation)
+        self.tiles[key] = tile
+        if len(self.tiles) > self.max_tiles:
+            # Evict the least recently used tile.
+            self.tiles.popitem(last=False)
+        return tile
+
+    def getTileKeys(self, x0, y0, x1, y1):
+        # Returns the keys of the tiles covering the image region
+        # (x0, y0) to (x1, y1).
+        last_x = (self.pixmap.width() - 1) // self.tile_size
+        last_y = (self.pixmap.height() - 1) // self.tile_size
+        first_tile_x = max(0, int(x0) // self.tile_size)
+        first_tile_y = max(0, int(y0) // self.tile_size)
+        last_tile_x = min(last_x, int(x1) // self.tile_size)
+        last_tile_y = min(last_y, int(y1) // self.tile_size)
+        return [(tile_x, tile_y)
+                for tile_y in range(first_tile_y, last_tile_y + 1)
+                for tile_x in range(first_tile_x, last_tile_x + 1)]
 
 
 class MiniGraphicsView(qtw.QGraphicsView):
@@ -917,18 +1195,47 @@ class MiniGraphicsView(qtw.QGraphicsView):
         super().__init__()
         self.setVerticalScrollBarPolicy(qtc.Qt.ScrollBarAlwaysOff)
         self.setHorizontalScrollBarPolicy(qtc.Qt.ScrollBarAlwaysOff)
-        self.fitInView(200-50, 200-50, 100, 100)
+        self.tile_cache = None
+        self.tile_items = {}
+
+    def setSource(self, pixmap, zoom):
+        # Sets the image shown in the magnifier. Any tiles of the
+        # previous image are removed from the scene.
+        for tile_item in self.tile_items.values():
+            self.scene().removeItem(tile_item)
+        self.tile_items = {}
+        self.tile_cache = MagnifierTileCache(pixmap, zoom)
+        self.scene().setSceneRect(
+            0, 0, pixmap.width() * zoom, pixmap.height() * zoom)
 
     def setView(self, x, y, cw):
-        if (x > cw.imageW - 25):
-            x = cw.imageW - 25
-        if (y > cw.imageH - 25):
-            y = cw.imageH - 25
-
-        x = x*2
-        y = y*2
+        # The view is never scaled, the scene contains pre-zoomed tiles
+        # around the cursor and the view is scrolled to centre them.
+        zoom = self.tile_cache.zoom
+        half_width = self.viewport().width() / (2 * zoom)
+        half_height = self.viewport().height() / (2 * zoom)
+        if (x > cw.imageW - half_width):
+            x = cw.imageW - half_width
+        if (y > cw.imageH - half_height):
+            y = cw.imageH - half_height
+
+        # Only the tiles in view are kept in the scene.
+        tile_keys = self.tile_cache.getTileKeys(
+            x - half_width, y - half_height, x + half_width, y + half_height)
+        for key in list(self.tile_items.keys()):
+            if key not in tile_keys:
+                self.scene().removeItem(self.tile_items.pop(key))
+        for key in tile_keys:
+            if key not in self.tile_items:
+                tile_item = self.scene().addPixmap(self.tile_cache.getTile(*key))
+                tile_position = self.tile_cache.tile_size * zoom
+                tile_item.setPos(key[0] * tile_position, key[1] * tile_position)
+                self.tile_items[key] = tile_item
+            else:
+                # Keep tiles in view marked as recently used.
+                self.tile_cache.getTile(*key)
 
-        self.fitInView(x-50, y-50, 100, 100)
+        self.centerOn(x * zoom, y * zoom)
 
 
 class MiniGraphicsScene(qtw.QGraphicsScene):
@@ -942,6 +1249,11 @@ class CutoutGraphicsScene(qtw.QGraphicsScene):
         self.currently_moving = None
         self.cw = cw
         self.point_manager = self.cw.getPointManager()
+        self.seed_box_mode = False
+        self.seed_box = None
+        self.orig_seed_point = None
+        self.pen = qtg.QPen(qtg.QBrush(qtg.QColor(0, 0, 255, 255)), 2)
+        self.pen.setStyle(qtc.Qt.DashLine)
 
     def setView(self, view):
         self.view = view
@@ -949,10 +1261,45 @@ class CutoutGraphicsScene(qtw.QGraphicsScene):
     def getView(self):
         return self.view
 
+    def setSeedBoxMode(self, seed_box_mode):
+        self.seed_box_mode = seed_box_mode
+
+    def getSeedBox(self):
+        # Returns the seed box drawn by the user as a normalised
+        # (x0, y0, x1, y1) tuple in image coordinates.
+        if self.seed_box is None:
+            return None
+        rect = self.seed_box.rect().normalized()
+        return (rect.left(), rect.top(), rect.right(), rect.bottom())
+
+    def deleteSeedBox(self):
+        if (self.seed_box):
+            self.removeItem(self.seed_box)
+            self.seed_box = None
+
     def mousePressEvent(self, event):
+        if (self.seed_box_mode is True):
+            # The user is drawing a box around the object to be cut
+            # out by the automatic cutout. Only one box is kept.
+            self.deleteSeedBox()
+            self.orig_seed_point = event.scenePos()
+            self.seed_box = self.addRect(
+                qtc.QRectF(self.orig_seed_point, self.orig_seed_point), self.pen)
+            self.seed_box.setZValue(100)
+            return
+
         # Add a path point at the coordinates clicked by the user
         self.point_manager.addPoint(event.scenePos().x(), event.scenePos().y())
 
+    def mouseMoveEvent(self, event):
+        if (self.seed_box_mode is True and self.orig_seed_point is not None):
+            # Update the seed box with the current cursor position.
+            self.seed_box.setRect(
+                qtc.QRectF(self.orig_seed_point, event.scenePos()))
+
+    def mouseReleaseEvent(self, event):
+        self.orig_seed_point = None
+
     def mouseDoubleClickEvent(self, event):
         pass
 
@@ -1246,6 +1593,16 @@ class CanvasGraphicsItem(qtw.QGraphicsPixmapItem):
     def getScale(self):
         return self.item_scale
 
+    def paint(self, painter, option, widget=None):
+        # A layer showing its preview decodes the full image once it is
+        # drawn with more detail than the preview holds.
+        if not self.image_layer.isLoaded():
+            detail = option.levelOfDetailFromTransform(painter.worldTransform())
+            ratio = self.image_layer.getImagePixmap().devicePixelRatio()
+            if detail / ratio > 1.25:
+                qtc.QTimer.singleShot(0, self.image_layer.ensureLoaded)
+        super().paint(painter, option, widget)
+
     def hoverEnterEvent(self, event):
         qtw.QApplication.setOverrideCursor(qtc.Qt.OpenHandCursor)
 
@@ -1318,14 +1675,27 @@ class LayerManager():
     active_layer = None
     num_layers = 0
 
-    def createNewLayer(image, layer_name, layer_z, layer_x, layer_y):
+    def createNewLayer(image, layer_name, layer_z, layer_x, layer_y,
+                       image_bytes=None, mask_bytes=None, preview=None,
+                       image_size=None, rendered=None):
         # Create a new ImageLayer and add it to the array of layers
-        new_layer = ImageLayer(image, layer_name, layer_z, layer_x, layer_y)
+        new_layer = ImageLayer(image, layer_name, layer_z, layer_x, layer_y,
+                               image_bytes, mask_bytes, preview, image_size,
+                               rendered)
         LayerManager.layers_container.append(new_layer)
         # increase the layer counter
         LayerManager.num_layers += 1
         return new_layer
 
+    def createNewGradientLayer(gradient, width, height, layer_name, layer_z,
+                               layer_x, layer_y):
+        # Create a new GradientLayer and add it to the array of layers
+        new_layer = GradientLayer(gradient, width, height, layer_name,
+                                  layer_z, layer_x, layer_y)
+        LayerManager.layers_container.append(new_layer)
+        LayerManager.num_layers += 1
+        return new_layer
+
     def disableAll():
         # Disable all layers in the canvas
         for layer in LayerManager.layers_container:
@@ -1350,13 +1720,15 @@ class LayerManager():
 
     def undoDeleteLayer(image_layer):
         # Unhides the layer when the user decides to undo
-        # the deletion of a layer.
+        # the deletion of a layer. A layer that was hidden by its
+        # layer widget stays hidden.
         layer_z_position = image_layer.getZPosition()
         for layer in LayerManager.layers_container:
             if layer.getZPosition() >= layer_z_position:
                 layer.setZPosition(layer.getZPosition() + 1)
         LayerManager.layers_container.append(image_layer)
-        image_layer.enableVisible()
+        if image_layer.getLayerWidget().is_layer_visible:
+            image_layer.enableVisible()
         image_layer.getLayerWidget().setVisible(True)
         image_layer.getRandomiseWidget().setVisible(True)
 
@@ -1416,19 +1788,173 @@ class LayerManager():
     def getYPosition(image_layer):
         image_layer.getYPosition()
 
+    def getCanvasLayers():
+        # Returns the pixels and canvas transforms of the visible
+        # layers from the bottom of the canvas up, as taken by
+        # composite_layers.
+        layers = [layer for layer in LayerManager.layers_container
+                  if layer.getLayerItem().isVisible()]
+        layers.sort(key=lambda layer: layer.getZPosition())
+        return [(layer.getCanvasSource(), layer.getCanvasTransform())
+                for layer in layers]
+
+
+class ImageStore():
+    # Decoded layer images keyed by the SHA-1 of their encoded data.
+    # Layers made from the same image share one decoded copy, which is
+    # kept for as long as a layer is using it.
+    images = weakref.WeakValueDictionary()
+    decoding = {}
+    lock = threading.Lock()
+
+    def key(data):
+        return hashlib.sha1(data).hexdigest()
+
+    def decode(image_bytes, key=None, cache=False):
+        # Returns the shared decoded image for the encoded data. Layers
+        # are decoded in a thread pool so each image is decoded by the
+        # first thread to ask for it while the others wait. Only images
+        # decoded with cache, those of projects, are added to the pixel
+        # cache.
+        if key is None:
+            key = ImageStore.key(image_bytes)
+        with ImageStore.lock:
+            image = ImageStore.images.get(key)
+            if image is not None:
+                return image
+            key_lock = ImageStore.decoding.setdefault(key, threading.Lock())
+        with key_lock:
+            with ImageStore.lock:
+                image = ImageStore.images.get(key)
+            if image is None:
+                # Images decoded in an earlier session are mapped from
+                # the pixel cache
+                image = PixelCache.load(key)
+                if image is None:
+                    image = decodeImageBytes(image_bytes)
+                    if cache:
+                        PixelCache.store(key, image)
+                with ImageStore.lock:
+                    ImageStore.images[key] = image
+                    ImageStore.decoding.pop(key, None)
+        return image
+
+
+class PixelCache():
+    # Decoded images kept on disk as .npy files named by the key of the
+    # encoded image they were decoded from. Files are memory mapped
+    # when loaded. They are written under a temporary name and renamed
+    # so that several instances of the app can share the cache, and
+    # the cache being unavailable only means images are decoded again.
+    modes = ("L", "RGB", "RGBA")
+    stores = 0
+
+    def getPath(key):
+        return pixel_cache_path / (key + ".npy")
+
+    def load(key):
+        # Returns the cached image for the key, or None
+        if pixel_cache_limit <= 0:
+            return None
+        path = PixelCache.getPath(key)
+        try:
+            pixels = np.load(path, mmap_mode="r")
+            # The modification time orders the files for eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return Image.fromarray(pixels)
+
+    def store(key, image):
+        # Images in modes that do not map directly onto an array, such
+        # as palette images, are not cached.
+        if pixel_cache_limit <= 0 or image.mode not in PixelCache.modes:
+            return
+        path = PixelCache.getPath(key)
+        temp_path = path.with_name("%s.%d.%d.tmp" % (
+            key, os.getpid(), threading.get_ident()))
+        try:
+            pixel_cache_path.mkdir(parents=True, exist_ok=True)
+            with open(temp_path, "wb") as cache_file:
+                np.save(cache_file, np.asarray(image))
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        with ImageStore.lock:
+            PixelCache.stores += 1
+            evict = PixelCache.stores % pixel_cache_evict_stores == 0
+        if evict:
+            PixelCache.evict()
+
+    def evict():
+        # Remove the least recently used files until the cache fits in
+        # its limit. Files in use by another instance may not be
+        # removable, they are skipped.
+        files = []
+        for path in pixel_cache_path.glob("*.npy"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= pixel_cache_limit:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+
 
 class ImageLayer:
 
-    def __init__(self, image, layer_name, layer_z, layer_x, layer_y):
+    def __init__(self, image, layer_name, layer_z, layer_x, layer_y,
+                 image_bytes=None, mask_bytes=None, preview=None,
+                 image_size=None, rendered=None):
         self.image_name = image
-        self.cropped_image_name = "cropped_" + self.image_name
-        self.altered_image_name = "altered_" + self.image_name
-
-        # Ensure that the cropped and altered version of the image file exist
-        self.cropped_image = Image.open(str(project_path / self.image_name))
-        self.cropped_image.save(str(project_path / self.cropped_image_name))
-        self.altered_image = Image.open(str(project_path / self.image_name))
-        self.altered_image.save(str(project_path / self.altered_image_name))
+        # Layers opened from a project keep their encoded image (and
+        # mask) rather than a file in the project folder. If an encoded
+        # preview is given it is shown until the full image is first
+        # needed.
+        self.image_bytes = image_bytes
+        self.image_key = None
+        self.mask_bytes = mask_bytes
+        self.mask_key = None
+        self.preview_bytes = preview
+        self.preview_key = None
+        self.preview_key_version = None
+        self.preview = None
+        self.preview_version = None
+        # The size of the cropped image of a layer showing its preview
+        self.image_size = tuple(image_size) if image_size else None
+
+        # Cutouts are stored in a separate 8-bit mask (None when the
+        # layer has not been cut) that is combined with the altered
+        # image, so changing a cut does not reapply the alterations.
+        self.mask = None
+        if rendered is not None:
+            # The (cropped, mask, adjusted, altered) images of a layer
+            # restored from a project, rendered on a worker thread. The
+            # layer's properties are restored to match them.
+            (self.cropped_image, self.mask, self.adjusted_image,
+             self.altered_image) = rendered
+        elif preview is None:
+            # The cropped version of the image is decoded once and kept
+            # in memory, tools that need the layer's pixels share it.
+            # Layer images are replaced rather than modified in place.
+            self.cropped_image = self.loadImage()
+            self.adjusted_image = applyMaskToImage(self.cropped_image, None)
+            self.altered_image = self.adjusted_image
+        else:
+            self.cropped_image = None
+            self.adjusted_image = None
+            self.altered_image = None
 
         self.layer_name = layer_name
 
@@ -1437,13 +1963,6 @@ class ImageLayer:
         self.layer_x_position = layer_x
         self.layer_y_position = layer_y
 
-        # Generate widget's to be displayed in the layer manager and
-        # randomisation tool.
-        self.layer_widget = None
-        self.randomise_widget = None
-        self.createNewLayerWidget()
-        self.createNewRandomiseWidget()
-
         # Initialise layer properties
         self.cropped = False
         self.rgb = [1, 1, 1]
@@ -1452,10 +1971,35 @@ class ImageLayer:
         self.sharpness = 1
         self.brightness = 1
         self.contrast = 1
+        # Colour statistics the layer is matched towards, None when
+        # the layer's colours are unchanged.
+        self.colour_match = None
+        self.colour_matched = None
+        self.lab_statistics = None
+        self.lab_statistics_image = None
         self.filters = []
-
-        # Create and position the layer item for the canvas
-        self.image_pixmap = qtg.QPixmap(str(project_path / self.image_name))
+        # The most recent colour palette generated from the layer. It
+        # is cached against the version of the layer's pixels it was
+        # computed from, the version is increased each time the
+        # displayed image is rebuilt.
+        self.palette = None
+        self.palette_version = None
+        self.pixel_version = 0
+        self.palette_task = None
+        # Coarse colour histogram of the visible pixels, also cached
+        # against the pixel version.
+        self.histogram = None
+        self.histogram_version = None
+
+        # Create and position the layer item for the canvas. A preview
+        # is drawn at the full image's size.
+        if preview is None:
+            self.image_pixmap = convertImageToPixmap(self.altered_image)
+        else:
+            self.preview = decodeImageBytes(preview)
+            self.image_pixmap = convertImageToPixmap(self.preview)
+            self.image_pixmap.setDevicePixelRatio(
+                self.preview.width / image_size[0])
         self.image_item = CanvasGraphicsItem(self.image_pixmap, self)
         self.image_item.setPos(self.layer_x_position, self.layer_y_position)
         self.image_item.setZValue(self.layer_z_position)
@@ -1465,7 +2009,117 @@ class ImageLayer:
         self.rotate_item = CanvasRotateItem(self.image_item)
         self.scale_item = CanvasScaleItem(self.image_item)
 
+        # Generate widget's to be displayed in the layer manager and
+        # randomisation tool.
+        self.layer_widget = None
+        self.randomise_widget = None
+        self.createNewLayerWidget()
+        self.createNewRandomiseWidget()
+
         self.disableAll()
+        if self.isLoaded():
+            self.schedulePalette()
+
+    def loadImage(self):
+        # Decode the layer's image, layers with the same image share it.
+        # Images of layers opened from a project, which come with a
+        # preview, are added to the pixel cache, imported images are
+        # not.
+        if self.image_bytes is not None:
+            return ImageStore.decode(self.image_bytes, self.getImageKey(),
+                                     cache=self.preview_bytes is not None)
+        return ImageStore.decode((project_path / self.image_name).read_bytes())
+
+    def getImageKey(self):
+        # Returns the SHA-1 of the layer's encoded image, or of its
+        # pixels once the image has been changed, under which it is
+        # stored in project files.
+        if self.image_key is None:
+            if self.image_bytes is not None:
+                self.image_key = ImageStore.key(self.image_bytes)
+            else:
+                self.image_key = imageKey(self.getCroppedImage())
+        return self.image_key
+
+    def isLoaded(self):
+        return self.cropped_image is not None
+
+    def ensureLoaded(self):
+        # Decode the full image of a layer that is showing its preview.
+        # Called before anything that needs the layer's pixels.
+        if self.cropped_image is not None:
+            return
+        self.cropped_image = self.loadImage()
+        if self.mask_bytes is not None:
+            self.mask = decodeImageBytes(self.mask_bytes).convert("L")
+            self.mask_bytes = None
+        palette = self.getCachedPalette()
+        self.applyAlterations()
+        if palette is not None:
+            # A palette restored with the project matches the pixels
+            self.setPalette(palette)
+
+    def getProjectEntries(self):
+        # Returns the ProjectEntry of the layer's image, preview and
+        # mask, None for those the layer does not store. Only the
+        # layer's current images and the keys it already knows are
+        # taken, they are hashed and encoded when the project is
+        # written. Gradient layers only store their parameters.
+        image = preview = mask = None
+        if not (isinstance(self, GradientLayer) and self.isParametric()):
+            if self.image_bytes is not None:
+                image = ProjectEntry('images', data=self.image_bytes,
+                                     key=self.image_key)
+            else:
+                image = ProjectEntry('images', image=self.getCroppedImage(),
+                                     key=self.image_key)
+            preview_key = None
+            if self.preview_key_version == self.pixel_version:
+                preview_key = self.preview_key
+            if not self.isLoaded():
+                preview = ProjectEntry('previews', data=self.preview_bytes,
+                                       key=preview_key)
+            else:
+                # The preview is made from the displayed image when it
+                # is written, unless it was made by an earlier save
+                reduced = None
+                if self.preview_version == self.pixel_version:
+                    reduced = self.preview
+                preview = ProjectEntry('previews', image=self.altered_image,
+                                       key=preview_key, preview=True,
+                                       reduced=reduced)
+        if self.mask_bytes is not None:
+            mask = ProjectEntry('masks', data=self.mask_bytes,
+                                key=self.mask_key)
+        elif self.isLoaded() and self.mask is not None:
+            mask = ProjectEntry('masks', image=self.mask, key=self.mask_key)
+        return image, preview, mask
+
+    def setProjectEntries(self, image, preview, mask):
+        # Keep the keys and the preview worked out when the entries
+        # from getProjectEntries were written, for the images the layer
+        # is still showing.
+        if image is not None and (image.getSource() is self.image_bytes or
+                                  image.getSource() is self.cropped_image):
+            self.image_key = image.getKey()
+        if mask is not None and (mask.getSource() is self.mask_bytes or
+                                 mask.getSource() is self.mask):
+            self.mask_key = mask.getKey()
+        if preview is None:
+            return
+        if preview.getSource() is self.altered_image:
+            self.preview = preview.getImage()
+            self.preview_version = self.pixel_version
+        if (preview.getSource() is self.altered_image or
+                preview.getSource() is self.preview_bytes):
+            self.preview_key = preview.getKey()
+            self.preview_key_version = self.pixel_version
+
+    def getImageSize(self):
+        # Returns the size of the cropped image without decoding it
+        if self.cropped_image is None:
+            return self.image_size
+        return self.cropped_image.size
 
     def createNewLayerWidget(self):
         # create a new layer widget
@@ -1609,43 +2263,93 @@ class ImageLayer:
         self.setXY(random_x, random_y)
 
     def applyAlterations(self):
-        self.new_image = Image.open(
-            str(project_path / self.cropped_image_name))
-        self.new_image.save(str(project_path / ("altered_" + self.image_name)))
-        self.new_name = "altered_" + self.image_name
-        if self.rgb != [1, 1, 1]:
-            # alter rgb
-            new_image = alterRGB(
-                self.new_name, self.rgb[0], self.rgb[1], self.rgb[2])
-            new_image.save(str(project_path / self.new_name))
-        if self.bw == True:
-            # apply bw
-            new_image = makeLayerBaW(self.new_name)
-            new_image.save(str(project_path / self.new_name))
-        if self.blur == True:
-            new_image = blurImage(self.new_name)
-            new_image.save(str(project_path / self.new_name))
-        if self.sharpness != 1:
-            # apply sharpness
-            new_image = enhanceSharpness(self.new_name, self.sharpness)
-            new_image.save(str(project_path / self.new_name))
-        if self.brightness != 1:
-            # apply brightness
-            new_image = enhanceBrightness(self.new_name, self.brightness)
-            new_image.save(str(project_path / self.new_name))
-        if self.contrast != 1:
-            # apply contrast
-            new_image = enhanceContrast(self.new_name, self.contrast)
-            new_image.save(str(project_path / self.new_name))
-
-        self.altered_image_name = self.new_name
+        if self.cropped_image is None:
+            # The alterations are applied as the image is decoded
+            self.ensureLoaded()
+            return
+        self.adjusted_image = self.renderAlterations()
+        self.compositeMask()
+
+    def renderAlterations(self):
+        # Returns the cropped image with the layer's alterations applied.
+        # Only pixels are touched so layers can be rendered on worker
+        # threads.
+        if self.colour_match is not None:
+            new_image = self.getColourMatchedImage()
+        else:
+            new_image = self.cropped_image.convert("RGBA")
+        return alterImage(new_image, self.rgb, self.bw, self.blur,
+                          self.sharpness, self.brightness, self.contrast)
+
+    def restoreProperties(self, properties):
+        # Set the layer's properties from its project manifest entry
+        # without rendering it or recording any actions. The layer
+        # must already be on the canvas.
+        self.setRGB(properties['r'], properties['g'], properties['b'])
+        self.setBW(properties['bw'])
+        self.setBlur(properties['blur'])
+        self.setSharpness(properties['sharpness'])
+        self.setBrightness(properties['brightness'])
+        self.setContrast(properties['contrast'])
+        self.setColourMatch(properties.get('colour match'))
+        self.setXY(properties['x'], properties['y'])
+        self.image_item.setRotation(properties['rotation'])
+        self.image_item.setScale(properties['scale'])
+        if not properties['visible']:
+            self.layer_widget.turnVisibleOff()
+        if properties.get('palette') is not None:
+            # The saved palette matches the restored pixels
+            self.setPalette(properties['palette'])
+
+    def isAltered(self):
+        # Returns True if any of the layer's alterations are applied
+        return (self.colour_match is not None or self.rgb != [1, 1, 1] or
+                self.bw or self.blur or self.sharpness != 1 or
+                self.brightness != 1 or self.contrast != 1)
+
+    def compositeMask(self):
+        # Combine the layer's mask with the altered image. This is the
+        # only step repeated when the layer's cutout changes.
+        self.setAlteredImages(
+            self.adjusted_image,
+            applyMaskToImage(self.adjusted_image, self.mask))
+
+    def setAlteredImages(self, adjusted_image, altered_image):
+        # Show altered images that have already been rendered
+        self.adjusted_image = adjusted_image
+        self.altered_image = altered_image
+        self.pixel_version += 1
         self.updatePixmap()
+        self.schedulePalette()
+
+    def schedulePalette(self):
+        # Computes the palette of the new pixels in the background so
+        # that it is ready when the gradient tool is opened. Work for
+        # pixels that have since been replaced is cancelled. The image
+        # is replaced rather than changed by edits, so it is converted
+        # to an array on the worker.
+        self.cancelPalette()
+        self.palette_task = BackgroundTask(
+            palette_task, self.altered_image, palette_size, self.palette)
+        version = self.pixel_version
+        self.palette_task.signals.finished.connect(
+            lambda palette: self.paletteFinished(version, palette))
+        self.palette_task.start(priority=-1)
+
+    def cancelPalette(self):
+        if self.palette_task is not None:
+            self.palette_task.cancel()
+            self.palette_task = None
+
+    def paletteFinished(self, version, palette):
+        # Results computed from old pixels are discarded
+        if version == self.pixel_version and self.getCachedPalette() is None:
+            self.setPalette(palette)
 
     def updatePixmap(self):
         # Update the layer's image in the canvas and the image
         # displayed in the layer's associated widget thumnbails.
-        self.image_pixmap = qtg.QPixmap(
-            str(project_path / self.altered_image_name))
+        self.image_pixmap = convertImageToPixmap(self.altered_image)
         self.image_item.setPixmap(self.image_pixmap)
         self.layer_widget.updateThumbnail()
         self.randomise_widget.updateThumbnail()
@@ -1656,8 +2360,121 @@ class ImageLayer:
     def getImagePixmap(self):
         return self.image_pixmap
 
+    def getThumbnail(self, width, height, mode):
+        # Returns the canvas pixmap scaled for the layer widgets, the
+        # pixmap of a preview has a device pixel ratio which the
+        # thumbnail should not keep.
+        thumbnail = self.image_pixmap.scaled(width, height, mode)
+        thumbnail.setDevicePixelRatio(1)
+        return thumbnail
+
     def getDisplayImage(self):
-        return self.altered_image_name
+        # Returns the layer image as shown on the canvas.
+        self.ensureLoaded()
+        return self.altered_image
+
+    def getCroppedImage(self):
+        # Returns the decoded layer image before alterations are applied.
+        self.ensureLoaded()
+        return self.cropped_image
+
+    def setCroppedImage(self, image):
+        self.cropped_image = image
+        self.image_bytes = None
+        self.image_key = None
+
+    def getPalette(self):
+        return self.palette
+
+    def getCachedPalette(self):
+        # Returns the palette if it was computed from the current
+        # pixels, otherwise None.
+        if self.palette_version == self.pixel_version:
+            return self.palette
+        return None
+
+    def setPalette(self, palette):
+        self.cancelPalette()
+        self.palette = palette
+        self.palette_version = self.pixel_version
+
+    def getPixelVersion(self):
+        return self.pixel_version
+
+    def getColourMatch(self):
+        return self.colour_match
+
+    def setColourMatch(self, colour_match):
+        self.colour_match = colour_match
+
+    def getLabStatistics(self):
+        # Returns the CIELAB mean and standard deviation of the cropped
+        # image, computed once for each cropped image.
+        self.ensureLoaded()
+        if self.lab_statistics_image is not self.cropped_image:
+            self.lab_statistics = image_lab_statistics(self.cropped_image)
+            self.lab_statistics_image = self.cropped_image
+        return self.lab_statistics
+
+    def getColourMatchedImage(self):
+        # Returns the cropped image with the colour match applied. The
+        # result is kept until the cropped image or the match changes.
+        if self.colour_matched is not None:
+            image, colour_match, matched_image = self.colour_matched
+            if image is self.cropped_image and colour_match == self.colour_match:
+                return matched_image
+        matched_image = colour_transfer(
+            self.cropped_image, self.getLabStatistics(),
+            (self.colour_match['mean'], self.colour_match['std']),
+            self.colour_match['strength'])
+        self.colour_matched = (self.cropped_image, self.colour_match,
+                               matched_image)
+        return matched_image
+
+    def getHistogramBins(self):
+        # Returns the (bins, colours, counts) histogram of the layer's
+        # visible pixels, only recomputed when the pixels change.
+        if self.histogram_version != self.pixel_version:
+            # Layers that have not been decoded use their preview
+            image = self.altered_image if self.isLoaded() else self.preview
+            self.histogram = colour_histogram_bins(
+                sample_pixels(np.asarray(image.convert("RGBA"))))
+            self.histogram_version = self.pixel_version
+        return self.histogram
+
+    def getHistogram(self):
+        # Returns the (colours, counts) histogram of the layer's
+        # visible pixels.
+        return self.getHistogramBins()[1:]
+
+    def renderCoverage(self, scale, width, height):
+        # Returns the layer's opacity (0 to 1) over a width x height
+        # copy of the canvas scaled down by scale.
+        coverage = qtg.QImage(width, height,
+                              qtg.QImage.Format_ARGB32_Premultiplied)
+        coverage.fill(0)
+        painter = qtg.QPainter(coverage)
+        painter.setTransform(self.image_item.sceneTransform() *
+                             qtg.QTransform.fromScale(scale, scale))
+        painter.drawPixmap(0, 0, self.image_pixmap)
+        painter.end()
+        alpha = convertQImageToImage(coverage).getchannel("A")
+        return np.asarray(alpha, dtype=np.float32) / 255
+
+    def getMask(self):
+        self.ensureLoaded()
+        return self.mask
+
+    def setMask(self, mask):
+        self.mask = mask
+        self.mask_bytes = None
+        self.mask_key = None
+
+    def getMaskedImage(self):
+        # Returns the cropped image with the mask applied but
+        # without alterations, as displayed in the cutout window.
+        self.ensureLoaded()
+        return applyMaskToImage(self.cropped_image, self.mask)
 
     def getSharpness(self):
         return self.sharpness
@@ -1739,6 +2556,36 @@ class ImageLayer:
     def getZPosition(self):
         return self.layer_z_position
 
+    def getCanvasSource(self):
+        # Returns the layer's pixels as taken by composite_layers. A
+        # layer showing its preview is decoded by the export rather
+        # than here.
+        if not self.isLoaded() and self.image_bytes is not None:
+            return CanvasLayerSource(
+                self.getImageSize(),
+                encoded=(self.image_bytes, self.mask_bytes),
+                properties=self.getRenderProperties())
+        image = self.getDisplayImage()
+        return CanvasLayerSource(image.size, image=image)
+
+    def getRenderProperties(self):
+        # Returns the layer's alterations as stored in a project
+        # manifest and taken by renderProjectLayer
+        return {'r': self.getR(), 'g': self.getG(), 'b': self.getB(),
+                'bw': self.getBW(), 'blur': self.getBlur(),
+                'sharpness': self.getSharpness(),
+                'brightness': self.getBrightness(),
+                'contrast': self.getContrast(),
+                'colour match': self.getColourMatch()}
+
+    def getCanvasTransform(self):
+        # Returns the affine transform (a, b, c, d, e, f) placing the
+        # layer image on the canvas, the image pixel (x, y) lands on
+        # the canvas at (a*x + b*y + c, d*x + e*y + f).
+        transform = self.image_item.sceneTransform()
+        return (transform.m11(), transform.m21(), transform.dx(),
+                transform.m12(), transform.m22(), transform.dy())
+
     def setZPosition(self, z):
         self.layer_z_position = z
         self.image_item.setZValue(z)
@@ -1810,15 +2657,15 @@ class ImageLayer:
     def disableVisible(self):
         self.image_item.setVisible(False)
 
-    def crop(self, x1, y1, x2, y2, originPoint):
-        # Create an image containing the rotated, scaled and altered
-        # version of the original image.
+    def renderTransformed(self, image):
+        # Create an image containing the rotated and scaled
+        # version of the provided image.
         crop_view = qtw.QGraphicsView()
         crop_view.setStyleSheet("background: transparent")
         crop_scene = qtw.QGraphicsScene()
         crop_view.setScene(crop_scene)
 
-        crop_pixmap = qtg.QPixmap(str(project_path / self.cropped_image_name))
+        crop_pixmap = convertImageToPixmap(image)
         crop_item = crop_scene.addPixmap(crop_pixmap)
         crop_item.setRotation(self.getLayerItem().getRotation())
         crop_item.setScale(self.getLayerItem().getScale())
@@ -1832,16 +2679,31 @@ class ImageLayer:
         painter2 = qtg.QPainter(temp_image)
         crop_scene.render(painter2)
         painter2.end()
-        temp_image.save(str(project_path / ("pre_crop_" + self.image_name)))
 
-        image = Image.open(str(project_path / ("pre_crop_" + self.image_name)))
-        orig_image = image
-        orig_image.load()
+        return convertQImageToImage(temp_image)
+
+    def crop(self, x1, y1, x2, y2, originPoint):
+        self.ensureLoaded()
+        # The image, mask, rotation and scale before the crop are kept
+        # for undoing it.
+        orig_image, orig_mask = self.cropped_image, self.mask
+        orig_rotation = self.getLayerItem().getRotation()
+        orig_scale = self.getLayerItem().getScale()
+        image = self.renderTransformed(self.cropped_image)
 
         cropped_image = cropImage(image, x1, y1, x2, y2)
         new_image = cropped_image
-        new_image.load()
-        cropped_image.save(str(project_path / ("cropped_" + self.image_name)))
+        self.setCroppedImage(cropped_image)
+
+        # The mask is rendered with the same rotation and scale
+        # so that it stays lined up with the cropped image.
+        new_mask = None
+        if self.mask is not None:
+            mask_image = Image.new("RGBA", self.mask.size, (255, 255, 255, 0))
+            mask_image.putalpha(self.mask)
+            transformed_mask = self.renderTransformed(mask_image).getchannel("A")
+            new_mask = cropImage(transformed_mask, x1, y1, x2, y2)
+        self.setMask(new_mask)
 
         self.getLayerItem().setRotation(0)
         self.getLayerItem().setScale(1)
@@ -1849,7 +2711,9 @@ class ImageLayer:
         orig_x, orig_y = self.getXPosition(), self.getYPosition()
         new_x, new_y = originPoint.x(), originPoint.y()
         coordinates = [orig_x, orig_y, new_x, new_y]
-        ActionManager.layerCropped(self, orig_image, new_image, coordinates)
+        ActionManager.layerCropped(
+            self, orig_image, new_image, coordinates, orig_mask, new_mask,
+            orig_rotation, orig_scale)
 
         self.setXY(new_x, new_y)
         self.applyAlterations()
@@ -1908,6 +2772,52 @@ class ImageLayer:
         self.image_item.setPos(x, y)
 
 
+class GradientLayer(ImageLayer):
+    # A layer generated from gradient parameters rather than an image
+    # file. Only the parameters are kept, the gradient is rasterized at
+    # the size it is needed (the canvas, a tile of it or an export).
+    # A gradient is a dictionary holding its 'kind' ('linear' or
+    # 'radial'), its colour 'stops' as [position, [r, g, b]] pairs and
+    # the 'angle' of a linear gradient in degrees.
+
+    def __init__(self, gradient, width, height, layer_name, layer_z,
+                 layer_x, layer_y):
+        self.gradient = gradient
+        self.gradient_size = (width, height)
+        super().__init__(None, layer_name, layer_z, layer_x, layer_y)
+
+    def loadImage(self):
+        return self.renderGradient(*self.gradient_size)
+
+    def renderGradient(self, width, height, box=None):
+        # Rasterize the gradient stretched over width x height pixels,
+        # box (x0, y0, x1, y1) limits the output to part of it.
+        return render_gradient(self.gradient, width, height, box)
+
+    def setCroppedImage(self, image):
+        # Once the layer is cropped its pixels no longer follow the
+        # gradient parameters, it is saved as an image from then on.
+        super().setCroppedImage(image)
+        self.gradient = None
+
+    def isParametric(self):
+        return self.gradient is not None
+
+    def getCanvasSource(self):
+        # A gradient is exported from its parameters unless its pixels
+        # have been altered or cut.
+        if (self.isParametric() and not self.isAltered() and
+                self.mask is None and self.mask_bytes is None):
+            return CanvasLayerSource(self.gradient_size, gradient=self.gradient)
+        return super().getCanvasSource()
+
+    def getGradient(self):
+        return self.gradient
+
+    def getGradientSize(self):
+        return self.gradient_size
+
+
 class RandomiseWidget(qtw.QWidget):
     # A widget displaying the layer information
     # and randomisation options.
@@ -1919,7 +2829,6 @@ class RandomiseWidget(qtw.QWidget):
         super().__init__()
         self.image_layer = imgLayer
         self.is_layer_locked = True
-        self.thumbnail_name = str(project_path / imgLayer.getImageName())
         self.layer_thumbnail_size = 50
         self.layer_name = imgLayer.getLayerName()
         self.position_locked = True
@@ -1963,7 +2872,7 @@ class RandomiseWidget(qtw.QWidget):
         self.layer_name.setFont(LayerWidget.title_font)
 
         # Layer thumbnail
-        self.layer_img = qtg.QPixmap(self.thumbnail_name).scaled(
+        self.layer_img = imgLayer.getThumbnail(
             self.layer_thumbnail_size, self.layer_thumbnail_size, qtc.Qt.KeepAspectRatio)
         self.layer_thumbnail_container_size = 75
         self.thumbnail_label = qtw.QLabel()
@@ -2248,7 +3157,7 @@ class RandomiseWidget(qtw.QWidget):
             mw.status_bar.showMessage("Option locked...", 2000)
 
     def updateThumbnail(self):
-        self.layer_img = self.image_layer.getImagePixmap().scaled(
+        self.layer_img = self.image_layer.getThumbnail(
             self.layer_thumbnail_size, self.layer_thumbnail_size, qtc.Qt.KeepAspectRatio)
         self.thumbnail_label.setPixmap(self.layer_img)
 
@@ -2264,7 +3173,6 @@ class LayerWidget(qtw.QWidget):
         self.image_layer = imgLayer
         self.is_layer_active = False
         self.is_layer_visible = True
-        self.thumbnail_name = str(project_path / imgLayer.getImageName())
         self.layer_thumbnail_size = 50
         self.layer_name = imgLayer.getLayerName()
 
@@ -2300,7 +3208,7 @@ class LayerWidget(qtw.QWidget):
         # Thumbnail widget
         # Set thumbnail size
         layer_thumbnail_size = 50
-        self.layer_img = qtg.QPixmap(self.thumbnail_name).scaled(
+        self.layer_img = imgLayer.getThumbnail(
             layer_thumbnail_size, layer_thumbnail_size, qtc.Qt.KeepAspectRatio)
         # Set thumbnail container size
         layer_thumbnail_container_size = 75
@@ -2357,7 +3265,7 @@ class LayerWidget(qtw.QWidget):
         self.layer_layout.addWidget(self.layer_details)
 
     def updateThumbnail(self):
-        self.layer_img = self.image_layer.getImagePixmap().scaled(
+        self.layer_img = self.image_layer.getThumbnail(
             self.layer_thumbnail_size, self.layer_thumbnail_size, qtc.Qt.KeepAspectRatio)
         self.thumbnail_label.setPixmap(self.layer_img)
 
@@ -2618,9 +3526,11 @@ class CutoutWindow(qtw.QWidget):
         self.point_manager.setLineManager()
 
         self.image_layer = imageCutoutLayer
-        self.cropped_image_name = self.image_layer.cropped_image_name
-        self.image_path = str(project_path / self.cropped_image_name)
-        self.imageW, self.imageH = Image.open(self.image_path).size
+        # The layer's decoded image is shared by the cutout view and the
+        # magnifier so opening the window does not read any files.
+        self.imageW, self.imageH = self.image_layer.getCroppedImage().size
+        self.image_pixmap = convertImageToPixmap(
+            self.image_layer.getMaskedImage())
 
         self.setLayout(qtw.QHBoxLayout())
 
@@ -2660,26 +3570,23 @@ class CutoutWindow(qtw.QWidget):
 
         # Mini scene
         self.mini_scene = MiniGraphicsScene()
-        self.mini_scene.setSceneRect(0, 0, Canvas.width()*2, Canvas.height()*2)
         self.mini_view.setScene(self.mini_scene)
 
-        # Put the layer image into the mini canvas
-        self.mini_canvas_pixmap = qtg.QPixmap(self.image_path)
-        self.mini_canvas_pixmap_item = qtw.QGraphicsPixmapItem(
-            self.mini_canvas_pixmap)
-        self.mini_add_item = self.mini_scene.addItem(
-            self.mini_canvas_pixmap_item)
-        # Scale the layer image by 2 (essentially zooming in)
-        self.mini_canvas_pixmap_item.setScale(2)
+        # Put the layer image into the mini canvas, the magnifier
+        # displays the image zoomed in by the zoom factor.
+        self.magnifier_zoom = 2
+        self.mini_view.setSource(self.image_pixmap, self.magnifier_zoom)
 
         # Add a cursor indicator image to the mini view
         self.indicator_pixmap = qtg.QPixmap(":/pixel_point.png")
         self.indicator_pixmap_item = qtw.QGraphicsPixmapItem(
             self.indicator_pixmap)
-        self.indicator_pixmap_item.setScale(2)
+        self.indicator_pixmap_item.setScale(self.magnifier_zoom)
+        self.indicator_pixmap_item.setZValue(100)
         self.indicator_add_item = self.mini_scene.addItem(
             self.indicator_pixmap_item)
-        self.indicator_pixmap_item.setPos(50*2, 50*2)
+        self.indicator_pixmap_item.setPos(
+            50*self.magnifier_zoom, 50*self.magnifier_zoom)
 
         self.graphics_scene = CutoutGraphicsScene(self)
         self.graphics_scene.setSceneRect(0, 0, self.imageW, self.imageH)
@@ -2688,8 +3595,7 @@ class CutoutWindow(qtw.QWidget):
 
         self.pen = qtg.QPen(qtg.QBrush(qtg.QColor(0, 0, 0, 255)), 2)
 
-        self.active_image_pixmap = qtg.QPixmap(self.image_path)
-        self.active_image_item = CutoutGraphicsItem(self.active_image_pixmap)
+        self.active_image_item = CutoutGraphicsItem(self.image_pixmap)
         self.add_active_image = self.graphics_scene.addItem(
             self.active_image_item)
         self.cutout_view.updateView()
@@ -2701,9 +3607,11 @@ class CutoutWindow(qtw.QWidget):
         self.cutout_tool_title = ToolTitleWidget("Cut-out")
         self.cutout_help_text = """<b>This tool allows you to cut-out a 2D shape from the image. You can draw 
         the path of the 2D shape by clicking on the canvas to plot path points. The 'Join Mask' option will attach 
-        the last path point to the first. The 'Smooth Edges' option will produce a cleaner cut-out by curving 
+        the last path point to the first. 'New Path' closes the current path so another can be plotted, with the 
+        'Even-Odd' fill rule a path inside another cuts a hole and separate paths cut separate islands. The 'Smooth Edges' option will produce a cleaner cut-out by curving 
         the edges of the path. You can increase the 'Soften Edges' value to blend the edges of the cut-out 
-        when you press 'Mask Image'.</b>"""
+        when you press 'Mask Image'. 'Auto Cutout' will find the object inside the drawn seed box, or inside 
+        the plotted path if no box has been drawn, and cut it out automatically.</b>"""
         self.cutout_tool_title.setHelpText(self.cutout_help_text)
         self.mask_options_layout.addWidget(self.cutout_tool_title)
 
@@ -2728,6 +3636,21 @@ class CutoutWindow(qtw.QWidget):
             lambda: self.point_manager.joinMask())
         self.mask_options_layout.addWidget(self.mask_join_button)
 
+        self.new_path_button = qtw.QPushButton("New Path")
+        self.new_path_button.clicked.connect(
+            lambda: self.point_manager.closePath())
+        self.mask_options_layout.addWidget(self.new_path_button)
+
+        self.fill_rule_widget = qtw.QWidget()
+        self.fill_rule_widget_layout = qtw.QFormLayout()
+        self.fill_rule_widget.setLayout(self.fill_rule_widget_layout)
+        self.fill_rule_input = qtw.QComboBox()
+        self.fill_rule_input.addItem("Even-Odd", qtc.Qt.OddEvenFill)
+        self.fill_rule_input.addItem("Non-Zero", qtc.Qt.WindingFill)
+        self.fill_rule_widget_layout.addRow(
+            qtw.QLabel("Fill Rule"), self.fill_rule_input)
+        self.mask_options_layout.addWidget(self.fill_rule_widget)
+
         self.undo_button = qtw.QPushButton("Undo Point")
         self.undo_button.clicked.connect(lambda: self.point_manager.undo())
         self.mask_options_layout.addWidget(self.undo_button)
@@ -2741,8 +3664,104 @@ class CutoutWindow(qtw.QWidget):
             lambda: self.point_manager.smoothEdges())
         self.mask_options_layout.addWidget(self.smooth_edges_button)
 
+        # Automatic cutout options
+        self.auto_cutout_task = None
+
+        self.seed_box_button = qtw.QPushButton("Draw Seed Box")
+        self.seed_box_button.setCheckable(True)
+        self.seed_box_button.toggled.connect(
+            self.graphics_scene.setSeedBoxMode)
+        self.mask_options_layout.addWidget(self.seed_box_button)
+
+        self.auto_cutout_button = qtw.QPushButton("Auto Cutout")
+        self.auto_cutout_button.clicked.connect(self.autoCutout)
+        self.mask_options_layout.addWidget(self.auto_cutout_button)
+
+        self.cancel_auto_cutout_button = qtw.QPushButton("Cancel Auto Cutout")
+        self.cancel_auto_cutout_button.setEnabled(False)
+        self.cancel_auto_cutout_button.clicked.connect(self.cancelAutoCutout)
+        self.mask_options_layout.addWidget(self.cancel_auto_cutout_button)
+
         self.show()
 
+    def updateImage(self, pixmap):
+        # Displays the layer image after it has been cut in both the
+        # cutout view and the magnifier.
+        self.image_pixmap = pixmap
+        self.active_image_item.setPixmap(pixmap)
+        self.mini_view.setSource(pixmap, self.magnifier_zoom)
+
+    def autoCutout(self):
+        # Starts the automatic cutout on a worker thread. The drawn seed
+        # box is used as the seed, otherwise the plotted path is used.
+        if self.auto_cutout_task is not None:
+            return
+        seed_box = self.graphics_scene.getSeedBox()
+        seed_paths = self.point_manager.getSubPaths()
+        if seed_box is None and not seed_paths:
+            mw.status_bar.showMessage(
+                "Draw a seed box or plot a path around the object...", 4000)
+            return
+
+        # The masked image is built on the worker thread from the
+        # layer's image and mask, which edits replace rather than change.
+        self.auto_cutout_task = BackgroundTask(
+            auto_cutout_task, self.image_layer.getCroppedImage(),
+            self.image_layer.getMask(), seed_box, seed_paths)
+        self.auto_cutout_task.signals.progress.connect(
+            self.autoCutoutProgress)
+        self.auto_cutout_task.signals.finished.connect(
+            self.autoCutoutFinished)
+        self.auto_cutout_task.signals.failed.connect(self.autoCutoutFailed)
+        self.auto_cutout_task.signals.cancelled.connect(
+            self.autoCutoutCancelled)
+        self.setAutoCutoutRunning(True)
+        self.auto_cutout_task.start()
+        mw.status_bar.showMessage("Auto cutout started...")
+
+    def cancelAutoCutout(self):
+        if self.auto_cutout_task is not None:
+            self.auto_cutout_task.cancel()
+            mw.status_bar.showMessage("Cancelling auto cutout...")
+
+    def setAutoCutoutRunning(self, running):
+        self.auto_cutout_button.setEnabled(not running)
+        self.mask_image_button.setEnabled(not running)
+        self.cancel_auto_cutout_button.setEnabled(running)
+
+    def autoCutoutProgress(self, percent):
+        mw.status_bar.showMessage(
+            "Auto cutout... " + str(percent) + "%")
+
+    def autoCutoutFinished(self, mask):
+        self.auto_cutout_task = None
+        self.setAutoCutoutRunning(False)
+        # The mask follows the same path as a plotted cutout so the
+        # edges can be softened and the cut can be undone.
+        self.point_manager.applyMask(
+            mask > 127, self.feather_factor_input.value())
+        self.graphics_scene.deleteSeedBox()
+        self.seed_box_button.setChecked(False)
+        mw.status_bar.showMessage("Auto cutout applied...", 4000)
+
+    def autoCutoutFailed(self, error):
+        self.auto_cutout_task = None
+        self.setAutoCutoutRunning(False)
+        mw.status_bar.showMessage("Auto cutout failed: " + error, 4000)
+
+    def autoCutoutCancelled(self):
+        self.auto_cutout_task = None
+        self.setAutoCutoutRunning(False)
+        mw.status_bar.showMessage("Auto cutout cancelled...", 4000)
+
+    def closeEvent(self, event):
+        # Stop any automatic cutout still running for this window.
+        self.cancelAutoCutout()
+        super().closeEvent(event)
+
+    def getFillRule(self):
+        return self.fill_rule_input.currentData()
+
     def getPointManager(self):
         return self.point_manager
 
@@ -2766,6 +3785,24 @@ class MainWindow(qtw.QMainWindow):
 
         self.current_stack_widget = None
         self.crop_mode = False
+        # The project file last saved or opened and its size and
+        # modification time at that point, saves to it are incremental.
+        self.project_file = None
+        self.project_stamp = None
+
+        # Images are saved on a worker thread
+        self.export_task = None
+
+        # Autosaves are written on a worker thread, the slot of the
+        # next autosave and the state of each slot's file are kept.
+        self.autosave_task = None
+        self.autosave_slot = 0
+        self.autosave_stamps = {}
+        self.autosave_state = None
+        self.autosave_snapshot = None
+        self.autosave_timer = qtc.QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
+        self.autosave_timer.start(autosave_interval)
 
         # Set main container
         # Vertical box that contains toolbar and main section
@@ -2942,6 +3979,14 @@ class MainWindow(qtw.QMainWindow):
         self.alignment_button.setIcon(qtg.QIcon(':/icon_align.png'))
         self.alignment_button.setIconSize(self.option_icon_size)
 
+        # Colour match option
+        self.colour_match_button = qtw.QPushButton('', self)
+        self.colour_match_button.setToolTip("Match Colours")
+        self.colour_match_button.setFlat(True)
+        self.colour_match_button.clicked.connect(self.handleColourMatchButton)
+        self.colour_match_button.setIcon(qtg.QIcon(':/icon_palette.png'))
+        self.colour_match_button.setIconSize(self.option_icon_size)
+
         # Cutout layer option
         self.cutout_button = qtw.QPushButton('', self)
         self.cutout_button.setToolTip("Cutout Image")
@@ -3326,6 +4371,23 @@ class MainWindow(qtw.QMainWindow):
         self.save_param_submit = qtw.QPushButton("Save As Image")
         self.save_param_submit.clicked.connect(self.saveSubmit)
 
+        self.save_param_width = qtw.QLineEdit()
+        self.save_param_width.setText(str(Canvas.width()))
+
+        # Compression runs from 0 (fastest) to 9 (smallest), quality
+        # from 1 to 100.
+        self.save_param_compression = qtw.QSpinBox()
+        self.save_param_compression.setRange(0, 9)
+        self.save_param_compression.setValue(6)
+        self.save_param_quality = qtw.QSpinBox()
+        self.save_param_quality.setRange(1, 100)
+        self.save_param_quality.setValue(90)
+        self.save_param_progressive = qtw.QCheckBox("Progressive JPEG")
+
+        self.save_param_cancel = qtw.QPushButton("Cancel Saving Image")
+        self.save_param_cancel.setEnabled(False)
+        self.save_param_cancel.clicked.connect(self.cancelExport)
+
         self.save_project_submit = qtw.QPushButton("Save As Project")
         self.save_project_submit.clicked.connect(self.saveProjectSubmit)
 
@@ -3333,7 +4395,14 @@ class MainWindow(qtw.QMainWindow):
         self.save_project_open.clicked.connect(self.openProjectSubmit)
 
         self.save_form_layout.addRow(self.save_label)
+        self.save_form_layout.addRow("Image width (px):", self.save_param_width)
+        self.save_form_layout.addRow("PNG/TIFF compression:",
+                                     self.save_param_compression)
+        self.save_form_layout.addRow("JPEG/WebP quality:",
+                                     self.save_param_quality)
+        self.save_form_layout.addRow(self.save_param_progressive)
         self.save_form_layout.addRow(self.save_param_submit)
+        self.save_form_layout.addRow(self.save_param_cancel)
         self.save_form_layout.addRow(self.save_project_submit)
         self.save_form_layout.addRow(self.save_project_open)
 
@@ -3473,6 +4542,63 @@ class MainWindow(qtw.QMainWindow):
         self.rgb_widget.setLayout(self.rgb_layout)
         self.rgb_layout.addWidget(self.rgb_form, alignment=qtc.Qt.AlignCenter)
 
+        # Colour match tool info
+        self.colour_match_widget = qtw.QWidget()
+        self.colour_match_form = qtw.QWidget()
+
+        self.colour_match_form_layout = qtw.QFormLayout()
+        self.colour_match_layout = qtw.QVBoxLayout()
+
+        self.colour_match_label = ToolTitleWidget("<b>Match Colours</b>")
+        self.colour_match_tooltip_text = """<b>The Match Colours tool moves the colours of the active 
+        layer towards the colours of another layer or of the whole canvas, so that photos taken in 
+        different light sit together. The strength controls how far the colours are moved, a preview 
+        is shown before the change is applied.</b>"""
+        self.colour_match_label.setHelpText(self.colour_match_tooltip_text)
+
+        self.colour_match_target = qtw.QComboBox()
+        self.colour_match_target.currentIndexChanged.connect(
+            self.updateColourMatchPreview)
+
+        self.colour_match_strength = qtw.QSlider()
+        self.colour_match_strength.setOrientation(qtc.Qt.Horizontal)
+        self.colour_match_strength.setRange(0, 100)
+        self.colour_match_strength.setSingleStep(1)
+        self.colour_match_strength.setValue(100)
+        self.colour_match_strength_label = qtw.QLabel()
+        self.colour_match_strength_label.setText(
+            str(self.colour_match_strength.value()) + "%")
+        self.colour_match_strength_label.setAlignment(qtc.Qt.AlignCenter)
+        self.colour_match_strength.valueChanged.connect(
+            self.updateColourMatchLabel)
+        self.colour_match_strength.valueChanged.connect(
+            self.updateColourMatchPreview)
+
+        self.colour_match_preview = qtw.QLabel()
+        self.colour_match_preview.setAlignment(qtc.Qt.AlignCenter)
+        self.colour_match_preview.setFixedSize(160, 160)
+        # The preview is drawn from a small copy of the active layer
+        self.colour_match_proxy = None
+
+        self.colour_match_submit = qtw.QPushButton("Match")
+        self.colour_match_submit.clicked.connect(self.colourMatchSubmit)
+        self.colour_match_all_submit = qtw.QPushButton("Match All Layers")
+        self.colour_match_all_submit.clicked.connect(self.colourMatchAllSubmit)
+
+        self.colour_match_form_layout.addRow(self.colour_match_label)
+        self.colour_match_form_layout.addRow(
+            qtw.QLabel("Match To"), self.colour_match_target)
+        self.colour_match_form_layout.addRow(self.colour_match_strength)
+        self.colour_match_form_layout.addRow(self.colour_match_strength_label)
+        self.colour_match_form_layout.addRow(self.colour_match_preview)
+        self.colour_match_form_layout.addRow(self.colour_match_submit)
+        self.colour_match_form_layout.addRow(self.colour_match_all_submit)
+
+        self.colour_match_form.setLayout(self.colour_match_form_layout)
+        self.colour_match_widget.setLayout(self.colour_match_layout)
+        self.colour_match_layout.addWidget(
+            self.colour_match_form, alignment=qtc.Qt.AlignCenter)
+
         # Gradient tool info
         self.gradient_widget = qtw.QWidget()
         self.gradient_container = qtw.QVBoxLayout()
@@ -3489,6 +4615,15 @@ class MainWindow(qtw.QMainWindow):
 
         self.gradient_submit = qtw.QPushButton("Get Active Layer Colours")
         self.gradient_submit.clicked.connect(self.gradientSubmit)
+        self.gradient_document_submit = qtw.QPushButton(
+            "Get Canvas Colours")
+        self.gradient_document_submit.clicked.connect(
+            self.gradientDocumentSubmit)
+        # The most recent palette of the whole canvas and the layer
+        # state it was computed from.
+        self.document_palette = None
+        self.document_palette_key = None
+        self.document_histogram = DocumentHistogram()
 
         self.gradient_grid = qtw.QGridLayout()
 
@@ -3497,6 +4632,15 @@ class MainWindow(qtw.QMainWindow):
         self.gradient_active_2 = qtw.QLabel()
         self.gradient_active_2.setFixedSize(30, 30)
 
+        self.gradient_kind_input = qtw.QComboBox()
+        self.gradient_kind_input.addItem(
+            "Vertical", {'kind': 'linear', 'angle': 90})
+        self.gradient_kind_input.addItem(
+            "Horizontal", {'kind': 'linear', 'angle': 0})
+        self.gradient_kind_input.addItem(
+            "Diagonal", {'kind': 'linear', 'angle': 45})
+        self.gradient_kind_input.addItem("Radial", {'kind': 'radial'})
+
         self.gradient_generate = qtw.QPushButton("Generate Gradient")
         self.gradient_generate.clicked.connect(self.gradientGenerate)
 
@@ -3505,13 +4649,16 @@ class MainWindow(qtw.QMainWindow):
         self.gradient_choices_layout.addWidget(self.gradient_active_1, 0, 0)
         self.gradient_choices_layout.addWidget(self.gradient_active_2, 0, 1)
         self.gradient_choices_layout.addWidget(
-            self.gradient_generate, 1, 0, 1, 2, alignment=qtc.Qt.AlignCenter)
+            self.gradient_kind_input, 1, 0, 1, 2)
+        self.gradient_choices_layout.addWidget(
+            self.gradient_generate, 2, 0, 1, 2, alignment=qtc.Qt.AlignCenter)
 
         GradientManager.setActive1Widget(self.gradient_active_1)
         GradientManager.setActive2Widget(self.gradient_active_2)
 
         self.gradient_layout.addRow(self.gradient_label)
         self.gradient_layout.addRow(self.gradient_submit)
+        self.gradient_layout.addRow(self.gradient_document_submit)
         self.gradient_layout.addRow(self.gradient_grid)
         self.gradientSubmit()
 
@@ -3657,6 +4804,7 @@ class MainWindow(qtw.QMainWindow):
         self.param_section.addWidget(self.alignment_widget)
         self.param_section.addWidget(self.cutout_widget)
         self.param_section.addWidget(self.gradient_widget)
+        self.param_section.addWidget(self.colour_match_widget)
         self.param_section.addWidget(self.randomise_container)
 
         self.param_section.setCurrentWidget(self.info_widget)
@@ -3718,6 +4866,7 @@ class MainWindow(qtw.QMainWindow):
         self.options_section_layout.addWidget(self.gradient_button, 4, 0)
         self.options_section_layout.addWidget(self.alignment_button, 4, 1)
         self.options_section_layout.addWidget(self.cutout_button, 0, 2)
+        self.options_section_layout.addWidget(self.colour_match_button, 5, 0)
 
         # Layer manager title and tooltip
         self.layer_manager_title = ToolTitleWidget("Layer Manager")
@@ -3751,6 +4900,9 @@ class MainWindow(qtw.QMainWindow):
     def updateContrastLabel(self, value):
         self.contrast_factor_label.setText(str(value) + "%")
 
+    def updateColourMatchLabel(self, value):
+        self.colour_match_strength_label.setText(str(value) + "%")
+
     def updateDetailsLabel(self, value):
         self.details_factor_label.setText(str(value) + "%")
 
@@ -3865,17 +5017,14 @@ class MainWindow(qtw.QMainWindow):
         new_layer_name = "Layer #" + str(LayerManager.num_layers + 1)
         new_layer_z = LayerManager.num_layers
 
-        new_image = Image.open(filepath)
-        # Generate a random filename for the image
-        uuid_hex = uuid.uuid4().hex
-        new_file_name = uuid_hex + '.png'
-        project_path.mkdir(parents=True, exist_ok=True)
-        new_filepath = project_path / new_file_name
-        new_image.save(new_filepath)
+        # The file is kept in its original encoding, it is decoded for
+        # the canvas and stored unchanged in saved projects.
+        image_bytes = Path(filepath).read_bytes()
 
         # Create and add the new layer
         new_layer = LayerManager.createNewLayer(
-            str(new_file_name), new_layer_name, new_layer_z, 0, 0)
+            os.path.basename(filepath), new_layer_name, new_layer_z, 0, 0,
+            image_bytes=image_bytes)
         self.addLayer(new_layer)
         mw.status_bar.showMessage("New layer added...", 4000)
 
@@ -3887,6 +5036,15 @@ class MainWindow(qtw.QMainWindow):
         self.addLayerWidget(layer)
         self.addRandomiseWidget(layer)
 
+    def addLayers(self, layers):
+        # Add several layers to the canvas as one action
+        for layer in layers:
+            self.addLayerToCanvas(layer)
+            self.addLayerWidget(layer)
+            self.addRandomiseWidget(layer)
+        if layers:
+            ActionManager.layersAdded(layers)
+
     def checkIfLayerExists(self, file_name):
         for layer in LayerManager.layers_container:
             if file_name == layer.getImageName():
@@ -3944,76 +5102,270 @@ class MainWindow(qtw.QMainWindow):
         self.param_section.setCurrentWidget(self.save_widget)
 
     def saveSubmit(self):
+        if self.export_task is not None:
+            return
         # Prompts the user for a filename input
         options = qtw.QFileDialog.Options()
         options |= qtw.QFileDialog.DontUseNativeDialog
-        file_name, _ = qtw.QFileDialog.getSaveFileName(
-            self, "Digital Collage Creator - Save Image", "", "Images (*.png)", options=options)
+        file_name, file_filter = qtw.QFileDialog.getSaveFileName(
+            self, "Digital Collage Creator - Save Image", "",
+            ";;".join(image_formats), options=options)
 
         if file_name:
             # User has entered a filename
-            file_name = os.path.basename(file_name) + ".png"
-            # The canvas image is drawn into a pixmap and saved as the entered filename
-            pixmap_to_save = qtg.QPixmap(Canvas.width(), Canvas.height())
-            painter = qtg.QPainter(pixmap_to_save)
-            rect = qtc.QRect(0, 0, Canvas.width(), Canvas.height())
-            self.canvas_scene.render(painter)
-            painter.end()
-            pixmap_to_save.save(file_name)
+            # Several widths separated by commas save one image of
+            # each width, named after the entered filename.
+            widths = [width.strip()
+                      for width in self.save_param_width.text().split(",")]
+            if not all(width.isdigit() and int(width) > 0 for width in widths):
+                mw.status_bar.showMessage("You must enter an image width...", 4000)
+                return
+            format, suffix = image_formats.get(file_filter, ("PNG", ".png"))
+            encoder_options = self.getEncoderOptions(format)
+            if Path(file_name).suffix.lower() == suffix:
+                file_name = file_name[:-len(suffix)]
+            if len(widths) == 1:
+                targets = [(file_name + suffix, int(widths[0]), format,
+                            encoder_options)]
+            else:
+                targets = [(file_name + "-" + width + suffix, int(width),
+                            format, encoder_options) for width in widths]
+            # The layers are composited from their full images at the
+            # entered widths, the handles and crop box drawn on the
+            # canvas are left out. The images are written on a worker
+            # thread from a snapshot of the layers, whose images are
+            # replaced rather than changed by edits.
+            self.export_task = BackgroundTask(
+                export_task, targets, LayerManager.getCanvasLayers(),
+                Canvas.width(), Canvas.height())
+            self.export_task.signals.progress.connect(self.exportProgress)
+            self.export_task.signals.finished.connect(self.exportFinished)
+            self.export_task.signals.failed.connect(self.exportFailed)
+            self.export_task.signals.cancelled.connect(self.exportCancelled)
+            self.setExportRunning(True)
+            self.export_task.start()
+            mw.status_bar.showMessage("Saving image...")
+
+    def getEncoderOptions(self, format):
+        # Returns the save options of an image format from the save
+        # panel, as taken by its strip writer in writeCanvasImages.
+        # compress_level goes to PNGStripWriter and TIFFStripWriter, the
+        # JPEG and WebP options are passed on to Pillow.
+        if format in ("PNG", "TIFF"):
+            return {"compress_level": self.save_param_compression.value()}
+        options = {"quality": self.save_param_quality.value()}
+        if format == "JPEG":
+            options["progressive"] = self.save_param_progressive.isChecked()
+            options["optimize"] = True
+        return options
+
+    def cancelExport(self):
+        if self.export_task is not None:
+            self.export_task.cancel()
+            mw.status_bar.showMessage("Cancelling saving image...")
+
+    def setExportRunning(self, running):
+        self.save_param_submit.setEnabled(not running)
+        self.save_param_cancel.setEnabled(running)
+
+    def exportProgress(self, percent):
+        mw.status_bar.showMessage("Saving image... " + str(percent) + "%")
+
+    def exportFinished(self, result):
+        self.export_task = None
+        self.setExportRunning(False)
         mw.status_bar.showMessage("Image saved...", 4000)
 
+    def exportFailed(self, error):
+        self.export_task = None
+        self.setExportRunning(False)
+        mw.status_bar.showMessage("Saving image failed: " + error, 4000)
+
+    def exportCancelled(self):
+        self.export_task = None
+        self.setExportRunning(False)
+        mw.status_bar.showMessage("Saving image cancelled...", 4000)
+
     def saveProjectSubmit(self):
         # Prompts the user for a filename input
         options = qtw.QFileDialog.Options()
         options |= qtw.QFileDialog.DontUseNativeDialog
         file_name, _ = qtw.QFileDialog.getSaveFileName(
-            self, "Digital Collage Creator - Save Project", "", "Text (*.dcc)", options=options)
+            self, "Digital Collage Creator - Save Project", "", "Project (*.dcc)", options=options)
         if file_name:
             # User has entered a filename
-            # Initiate a dictionary to store the project details
-            project_data = {}
-            project_data['layers'] = []
-
-            for layer in LayerManager.layers_container:
-                # For each layer in the canvas add an entry to the
-                # project dictionary containing layer info.
-
-                # Convert the image into a string reperesentation
-                # using base 64 encoding.
-                buffered = BytesIO()
-                layer_image = Image.open(
-                    str(project_path / layer.getImageName()))
-                layer_image.save(buffered, format="PNG")
-                binary_image_data = base64.b64encode(buffered.getvalue())
-                str_image_data = binary_image_data.decode('utf-8')
-
-                # Insert the information into the dictionary
-                project_data['layers'].append({
-                    'x': layer.getXPosition(),
-                    'y': layer.getYPosition(),
-                    'z': layer.getZPosition(),
-                    'image name': layer.getImageName(),
-                    'layer name': layer.getLayerName(),
-                    'r': layer.getR(),
-                    'g': layer.getG(),
-                    'b': layer.getB(),
-                    'bw': layer.getBW(),
-                    'blur': layer.getBlur(),
-                    'sharpness': layer.getSharpness(),
-                    'brightness': layer.getBrightness(),
-                    'contrast': layer.getContrast(),
-                    'visible': layer.getLayerWidget().is_layer_visible,
-                    'rotation': layer.getLayerItem().getRotation(),
-                    'scale': layer.getLayerItem().getScale(),
-                    'img str': str_image_data
-                })
-
-            # Convert the dictionary content into .json format
-            # Save the .json data in the filename netered by the user
-            with open(file_name, 'w') as outfile:
-                json.dump(project_data, outfile)
+            self.saveProject(file_name)
             mw.status_bar.showMessage("Project saved...", 4000)
 
+    def saveProject(self, file_name):
+        # Saving again to the project last saved or opened appends only
+        # the entries that changed (see writeProjectArchive).
+        layers = list(LayerManager.layers_container)
+        snapshot = self.snapshotProject()
+        self.addCanvasPreview(snapshot)
+        project_data, entries = resolveProjectEntries(snapshot)
+        append = (file_name == self.project_file and
+                  fileStamp(file_name) == self.project_stamp)
+        writeProjectArchive(file_name, project_data, entries, append)
+        self.setProjectFile(file_name)
+        self.keepProjectEntries(layers, snapshot)
+
+    def snapshotProject(self):
+        # Returns the project's manifest data with a ProjectEntry in
+        # place of the name of each image entry, see
+        # resolveProjectEntries. The entries hold the layers' current
+        # images, which are replaced rather than changed by edits, so
+        # the snapshot can be written while editing carries on.
+        project_data = {}
+        project_data['format'] = 3
+        project_data['layers'] = []
+        for layer in LayerManager.layers_container:
+            # For each layer in the canvas add an entry to the
+            # project dictionary containing layer info.
+            project_data['layers'].append(self.saveProjectLayer(layer))
+        return project_data
+
+    def addCanvasPreview(self, project_data):
+        project_data['preview'] = ProjectEntry(
+            'previews', image=self.renderCanvasPreview())
+
+    def keepProjectEntries(self, layers, snapshot):
+        # Pass the keys found while writing a snapshot back to its
+        # layers so they are not worked out again by the next save.
+        for layer, layer_data in zip(layers, snapshot['layers']):
+            layer.setProjectEntries(layer_data['image'],
+                                    layer_data['preview'], layer_data['mask'])
+
+    def autosave(self):
+        # Called by the autosave timer. The snapshot is taken here and
+        # written into the next autosave slot in the background, a
+        # project that has not changed since the last autosave is
+        # skipped.
+        if self.autosave_task is not None:
+            return
+        if not LayerManager.layers_container:
+            return
+        layers = list(LayerManager.layers_container)
+        snapshot = self.snapshotProject()
+        # The images are compared by identity. The last autosaved
+        # snapshot is kept so the objects it refers to stay alive and
+        # their ids are not reused.
+        state = json.dumps(snapshot,
+                           default=lambda entry: id(entry.getSource()))
+        if state == self.autosave_state:
+            return
+        self.addCanvasPreview(snapshot)
+
+        slot = self.autosave_slot
+        autosave_path.mkdir(parents=True, exist_ok=True)
+        file_name = str(autosave_path / ('autosave-' + str(slot) + '.dcc'))
+        append = (self.autosave_stamps.get(slot) is not None and
+                  fileStamp(file_name) == self.autosave_stamps.get(slot))
+        self.autosave_task = BackgroundTask(
+            autosave_task, file_name, snapshot, append)
+        self.autosave_task.signals.finished.connect(
+            lambda result: self.autosaveFinished(
+                slot, file_name, state, layers, snapshot))
+        self.autosave_task.signals.failed.connect(self.autosaveFailed)
+        self.autosave_task.signals.cancelled.connect(self.autosaveCancelled)
+        self.autosave_task.start(priority=-1)
+
+    def autosaveFinished(self, slot, file_name, state, layers, snapshot):
+        self.autosave_task = None
+        self.autosave_stamps[slot] = fileStamp(file_name)
+        self.autosave_state = state
+        self.autosave_snapshot = snapshot
+        self.autosave_slot = (slot + 1) % autosave_slots
+        self.keepProjectEntries(layers, snapshot)
+        mw.status_bar.showMessage("Project autosaved...", 4000)
+
+    def autosaveFailed(self, error):
+        self.autosave_task = None
+        mw.status_bar.showMessage("Autosave failed: " + error, 4000)
+
+    def autosaveCancelled(self):
+        self.autosave_task = None
+
+    def setProjectFile(self, file_name):
+        # Remember the project file so that the next save can append
+        self.project_file = file_name
+        self.project_stamp = fileStamp(file_name)
+
+    def saveProjectLayer(self, layer):
+        # Returns the layer's manifest entry. The cropped image is saved
+        # so that crops are kept, cutouts are kept in the layer's mask.
+        # Layers using the same image refer to one entry. Layers that
+        # have not been decoded since the project was opened are
+        # written from their encoded image, mask and preview.
+        gradient = None
+        if isinstance(layer, GradientLayer) and layer.isParametric():
+            gradient = {'params': layer.getGradient(),
+                        'size': layer.getGradientSize()}
+        image_entry, preview_entry, mask_entry = layer.getProjectEntries()
+
+        return {
+            'x': layer.getXPosition(),
+            'y': layer.getYPosition(),
+            'z': layer.getZPosition(),
+            'image name': layer.getImageName(),
+            'layer name': layer.getLayerName(),
+            'r': layer.getR(),
+            'g': layer.getG(),
+            'b': layer.getB(),
+            'bw': layer.getBW(),
+            'blur': layer.getBlur(),
+            'sharpness': layer.getSharpness(),
+            'brightness': layer.getBrightness(),
+            'contrast': layer.getContrast(),
+            'colour match': layer.getColourMatch(),
+            'visible': layer.getLayerWidget().is_layer_visible,
+            'rotation': layer.getLayerItem().getRotation(),
+            'scale': layer.getLayerItem().getScale(),
+            'image': image_entry,
+            'size': layer.getImageSize(),
+            'preview': preview_entry,
+            'gradient': gradient,
+            'mask': mask_entry,
+            'palette': layer.getCachedPalette()
+        }
+
+    def renderCanvasPreview(self, size=512):
+        # Returns a small image of the canvas stored with the project.
+        # Only the visible layer items are drawn, from the pixmaps they
+        # are showing, so the handles and crop box of the scene are left
+        # out and the background stays transparent.
+        scale = size / max(Canvas.width(), Canvas.height())
+        preview = qtg.QImage(round(Canvas.width() * scale),
+                             round(Canvas.height() * scale),
+                             qtg.QImage.Format_ARGB32)
+        preview.fill(qtc.Qt.transparent)
+        painter = qtg.QPainter(preview)
+        painter.setRenderHint(qtg.QPainter.SmoothPixmapTransform)
+        option = qtw.QStyleOptionGraphicsItem()
+        layers = [layer for layer in LayerManager.layers_container
+                  if layer.getLayerItem().isVisible()]
+        layers.sort(key=lambda layer: layer.getZPosition())
+        for layer in layers:
+            item = layer.getLayerItem()
+            painter.setTransform(item.sceneTransform() *
+                                 qtg.QTransform.fromScale(scale, scale))
+            item.paint(painter, option)
+        painter.end()
+        return convertQImageToImage(preview)
+
+    def showCanvasPreview(self, preview_bytes):
+        # Show a project's canvas preview above the canvas and paint it
+        # straight away, as the project's layers are made before the
+        # event loop runs again. Returns the item, which is removed
+        # once the layers are shown.
+        preview = decodeImageBytes(preview_bytes)
+        item = self.canvas_scene.addPixmap(convertImageToPixmap(preview))
+        item.setTransformationMode(qtc.Qt.SmoothTransformation)
+        item.setScale(Canvas.width() / preview.width)
+        item.setZValue(LayerManager.num_layers + 100)
+        self.canvas_view.viewport().repaint()
+        return item
+
     def openProjectSubmit(self):
         # Prompt the user for the file location of the project
         filepath = self.openProjectDialog()
@@ -4025,82 +5377,184 @@ class MainWindow(qtw.QMainWindow):
             mw.status_bar.showMessage("Unsupported file type...", 4000)
             return
 
-        with open(filepath) as json_file:
-            # Load the project json data into an dictionary
-            data = json.load(json_file)
-            # Loop through each layer in the data
-            for layer in data['layers']:
-                layer_x = layer['x']
-                layer_y = layer['y']
-                layer_z = layer['z']
-                r = layer['r']
-                g = layer['g']
-                b = layer['b']
-                bw = layer['bw']
-                blur = layer['blur']
-                sharpness = layer['sharpness']
-                brightness = layer['brightness']
-                contrast = layer['contrast']
-                visible = layer['visible']
-                rotation = layer['rotation']
-                scale = layer['scale']
-                layer_name = layer['layer name']
-                str_image_data = layer['img str']
-
-                # Build the image from the string representation
-                t_data = str_image_data.encode('utf-8')
-                img = base64.b64decode(t_data)
-                image = Image.open(BytesIO(img))
-
-                # Generate a new filename
-                uuid_hex = uuid.uuid4().hex
-                new_file_name = uuid_hex + '.png'
-                project_path.mkdir(parents=True, exist_ok=True)
-                new_filepath = project_path / new_file_name
-                # Save the layer image
-                image.save(new_filepath)
-
-                # Create a new layer
-                new_layer = LayerManager.createNewLayer(
-                    str(new_file_name), layer_name, layer_z, layer_x, layer_y)
-                self.addLayer(new_layer)
-
-                # Set the layer properties
-                new_layer.setRGB(r, g, b)
-                new_layer.setBW(bw)
-                new_layer.setBlur(blur)
-                new_layer.setSharpness(sharpness)
-                new_layer.setBrightness(brightness)
-                new_layer.setContrast(contrast)
+        if zipfile.is_zipfile(filepath):
+            # Layer images are read from the archive as they are needed.
+            # The newest manifest describes the project, earlier ones
+            # are left by incremental saves.
+            with zipfile.ZipFile(filepath) as archive:
+                version = latestManifestVersion(archive.namelist())
+                if version > 0:
+                    manifest_name = 'manifests/' + str(version) + '.json'
+                else:
+                    manifest_name = 'manifest.json'
+                data = json.loads(archive.read(manifest_name))
+                canvas_preview = None
+                if data.get('preview') is not None:
+                    canvas_preview = self.showCanvasPreview(
+                        archive.read(data['preview']))
+                try:
+                    self.openProjectLayers(data['layers'], archive)
+                finally:
+                    if canvas_preview is not None:
+                        self.canvas_scene.removeItem(canvas_preview)
+            self.setProjectFile(filepath)
+        else:
+            # Projects saved before the zip format are a single JSON
+            # file with the images stored as base 64 strings.
+            with open(filepath) as json_file:
+                data = json.load(json_file)
+            self.openProjectLayers(data['layers'], None)
+
+    def openProjectLayers(self, layers, archive):
+        # The pixel work of every layer, decoding it and replaying its
+        # alterations, runs in a thread pool before the layers are
+        # made, so each layer is drawn once. Only the Qt items are made
+        # on the GUI thread and the open is a single undo action.
+        # Image entries shared by several layers are read once.
+        entries = {}
+        sources = [self.readProjectLayer(layer, archive, entries)
+                   for layer in layers]
+        with ThreadPoolExecutor() as executor:
+            rendered = list(executor.map(
+                lambda layer, source: renderProjectLayer(
+                    decodeProjectLayer(*source), layer),
+                layers, sources))
+
+        new_layers = [
+            self.createProjectLayer(layer, archive, entries, source[0],
+                                    images)
+            for layer, source, images in zip(layers, sources, rendered)]
+        self.addLayers(new_layers)
+        for layer, new_layer in zip(layers, new_layers):
+            new_layer.restoreProperties(layer)
+            if isinstance(new_layer, GradientLayer) and new_layer.isAltered():
+                # Gradients are drawn as they are made
                 new_layer.applyAlterations()
-                new_layer.setXY(layer_x, layer_y)
-                if not visible:
-                    new_layer.getLayerWidget().toggleLayerVisible()
-                new_layer.getLayerItem().setRotation(rotation)
-                new_layer.getLayerItem().setScale(scale)
+
+    def readProjectLayer(self, layer, archive, entries):
+        # Returns the encoded (image, mask) of a layer that is opened
+        # in full, or (None, None) when there is nothing to decode.
+        if layer.get('gradient') is not None:
+            # Gradient layers are rebuilt from their parameters
+            return None, None
+        if archive is None:
+            # Projects in the earlier JSON format hold string
+            # representations of the image and mask
+            mask_bytes = None
+            if layer.get('mask str') is not None:
+                mask_bytes = base64.b64decode(
+                    layer['mask str'].encode('utf-8'))
+            return base64.b64decode(layer['img str'].encode('utf-8')), \
+                mask_bytes
+        if layer.get('preview') is not None:
+            # The layer is shown from its preview, the encoded image
+            # and mask are only decoded when they are needed.
+            return None, None
+        mask_bytes = None
+        if layer['mask'] is not None:
+            mask_bytes = archive.read(layer['mask'])
+        return readSharedEntry(archive, layer['image'], entries), mask_bytes
+
+    def createProjectLayer(self, layer, archive, entries, image_bytes,
+                           rendered):
+        # Creates a layer from its project details and the images
+        # rendered for it
+        layer_x = layer['x']
+        layer_y = layer['y']
+        layer_z = layer['z']
+        layer_name = layer['layer name']
+        image_name = layer.get('image name')
+        gradient = layer.get('gradient')
+
+        if gradient is not None:
+            width, height = gradient['size']
+            new_layer = LayerManager.createNewGradientLayer(
+                gradient['params'], width, height, layer_name,
+                layer_z, layer_x, layer_y)
+            # A cut gradient keeps its parameters and its mask
+            mask_bytes = None
+            if archive is None:
+                if layer.get('mask str') is not None:
+                    mask_bytes = base64.b64decode(
+                        layer['mask str'].encode('utf-8'))
+            elif layer.get('mask') is not None:
+                mask_bytes = archive.read(layer['mask'])
+            if mask_bytes is not None:
+                new_layer.setMask(decodeImageBytes(mask_bytes).convert("L"))
+                new_layer.compositeMask()
+            return new_layer
+        if rendered is None:
+            mask_bytes = None
+            if layer['mask'] is not None:
+                mask_bytes = archive.read(layer['mask'])
+            return LayerManager.createNewLayer(
+                image_name, layer_name, layer_z, layer_x, layer_y,
+                image_bytes=readSharedEntry(archive, layer['image'], entries),
+                mask_bytes=mask_bytes,
+                preview=archive.read(layer['preview']),
+                image_size=layer['size'])
+        return LayerManager.createNewLayer(
+            image_name, layer_name, layer_z, layer_x, layer_y,
+            image_bytes=image_bytes, rendered=rendered)
 
     def cutoutSubmit(self):
         # Open a cutout window for the active layer
         if LayerManager.getActiveLayer():
             image_layer = LayerManager.getActiveLayer()
-            cw = CutoutWindow(image_layer)
+            self.cutout_window = CutoutWindow(image_layer)
 
     def gradientSubmit(self):
-        number_of_colours = 7
+        layer_colours = None
+        if LayerManager.getActiveLayer():
+            image_layer = LayerManager.getActiveLayer()
+            layer_colours = image_layer.getCachedPalette()
+            if layer_colours is None:
+                # Get the layer's colour palette from the visible pixels
+                # of its canvas image, the previous palette is used as
+                # the starting point for the clustering.
+                altered_image = image_layer.getDisplayImage()
+                layer_colours = get_colours(np.asarray(altered_image),
+                                            palette_size, False,
+                                            image_layer.getPalette())
+                image_layer.setPalette(layer_colours)
+        self.populateGradientColours(layer_colours)
+
+    def gradientDocumentSubmit(self):
+        # Get the palette of the visible layers as seen in the canvas
+        layers = [layer for layer in LayerManager.layers_container
+                  if layer.getLayerWidget().is_layer_visible]
+        # The palette only needs updating when a layer's pixels,
+        # placement or visibility has changed.
+        document_key = [(id(layer), layer.getPixelVersion(),
+                         layer.getZPosition(),
+                         layer.getLayerItem().sceneTransform())
+                        for layer in layers]
+        if document_key != self.document_palette_key:
+            self.document_palette = get_document_colours(
+                self.document_histogram, layers, Canvas.width(),
+                Canvas.height(), palette_size, self.document_palette)
+            self.document_palette_key = document_key
+        self.populateGradientColours(self.document_palette)
+
+    def populateGradientColours(self, layer_colours):
+        # Fill the colour choice rows with the palette colours, or a
+        # greyscale sequence when there is no palette.
+        number_of_colours = palette_size
+        # Remove the colour choices from the previous palette, the
+        # chosen colours are cleared as their labels are deleted.
+        GradientManager.clearActiveLabel1()
+        GradientManager.clearActiveLabel2()
+        while self.gradient_grid.count():
+            widget = self.gradient_grid.takeAt(0).widget()
+            if widget is not None:
+                widget.deleteLater()
+
         colour_label_1 = qtw.QLabel("<b>Colour 1:</b>")
         colour_label_2 = qtw.QLabel("<b>Colour 2:</b>")
         self.gradient_grid.addWidget(colour_label_1, 0, 0)
         self.gradient_grid.addWidget(colour_label_2, 1, 0)
 
-        if LayerManager.getActiveLayer():
-            # Get the layer's canvas image
-            image_layer = LayerManager.getActiveLayer()
-            altered_image_name = image_layer.getDisplayImage()
-
-            # Get the layer's colour palette
-            layer_colours = get_colours(get_image(str(project_path / altered_image_name)),
-                                        number_of_colours, False)
-
+        if layer_colours is not None:
             counter = 0
             for colour in layer_colours:
                 # Convert the colour from hex representation to RGB
@@ -4149,20 +5603,16 @@ class MainWindow(qtw.QMainWindow):
         c1 = convertRGBStrToTuple(c1)
         c2 = convertRGBStrToTuple(c2)
 
-        # Get an array containing the colour values of the gradient image
-        gradient_colours = gradient_array(
-            Canvas.width(), Canvas.height(), c1, c2, (False, False, False))
-
-        # Create and add a layer containing the new gradient image
-        layer_number = LayerManager.num_layers + 1
-        file_name = 'gradient' + str(layer_number) + '.png'
-        Image.fromarray(np.uint8(gradient_colours)).save(
-            str(project_path / file_name))
+        # Describe the gradient, it is rasterized by the new layer
+        gradient = dict(self.gradient_kind_input.currentData())
+        gradient['stops'] = [[0, list(c1)], [1, list(c2)]]
 
+        # Create and add a layer containing the new gradient
         new_layer_name = "Layer #" + str(LayerManager.num_layers + 1)
         new_layer_z = LayerManager.num_layers
-        new_layer = LayerManager.createNewLayer(
-            file_name, new_layer_name, new_layer_z, 0, 0)
+        new_layer = LayerManager.createNewGradientLayer(
+            gradient, Canvas.width(), Canvas.height(), new_layer_name,
+            new_layer_z, 0, 0)
         self.addLayer(new_layer)
 
     def undoAction(self):
@@ -4175,6 +5625,9 @@ class MainWindow(qtw.QMainWindow):
         self.param_section.setCurrentWidget(self.cutout_widget)
 
     def handleGradientButton(self):
+        # Show the active layer's palette, normally it has already been
+        # computed in the background.
+        self.gradientSubmit()
         self.param_section.setCurrentWidget(self.gradient_widget)
 
     def handleBrightnessButton(self):
@@ -4405,6 +5858,95 @@ class MainWindow(qtw.QMainWindow):
     def handleContrastButton(self):
         self.param_section.setCurrentWidget(self.contrast_widget)
 
+    def handleColourMatchButton(self):
+        # List the canvas and the layers as colour targets
+        self.colour_match_target.blockSignals(True)
+        self.colour_match_target.clear()
+        self.colour_match_target.addItem("Canvas Colours", None)
+        for layer in LayerManager.layers_container:
+            self.colour_match_target.addItem(layer.getLayerName(), layer)
+        self.colour_match_target.blockSignals(False)
+        self.updateColourMatchPreview()
+        self.param_section.setCurrentWidget(self.colour_match_widget)
+
+    def getColourMatchTarget(self):
+        # Returns the CIELAB (mean, standard deviation) of the chosen
+        # layer, or of the visible canvas when no layer is chosen.
+        target_layer = self.colour_match_target.currentData()
+        if target_layer is not None:
+            colours, counts = target_layer.getHistogram()
+        else:
+            layers = [layer for layer in LayerManager.layers_container
+                      if layer.getLayerWidget().is_layer_visible]
+            colours, counts = self.document_histogram.update(
+                layers, Canvas.width(), Canvas.height())
+        if len(colours) == 0:
+            return None
+        return lab_statistics(colours, counts)
+
+    def getColourMatch(self, target):
+        mean, std = target
+        return {'mean': mean, 'std': std,
+                'strength': self.colour_match_strength.value() / 100}
+
+    def updateColourMatchPreview(self):
+        layer = LayerManager.getActiveLayer()
+        if layer is None:
+            self.colour_match_preview.clear()
+            return
+        target = self.getColourMatchTarget()
+        if target is None:
+            return
+        # The small copy is only rebuilt when the layer's image changes
+        if (self.colour_match_proxy is None or
+                self.colour_match_proxy[0] is not layer.getCroppedImage()):
+            proxy = layer.getCroppedImage().convert("RGBA")
+            proxy.thumbnail((160, 160))
+            self.colour_match_proxy = (layer.getCroppedImage(), proxy)
+        colour_match = self.getColourMatch(target)
+        preview = colour_transfer(
+            self.colour_match_proxy[1], layer.getLabStatistics(),
+            target, colour_match['strength'])
+        self.colour_match_preview.setPixmap(convertImageToPixmap(preview))
+
+    def colourMatchSubmit(self):
+        layer = LayerManager.getActiveLayer()
+        if layer:
+            target = self.getColourMatchTarget()
+            if target is None:
+                return
+            self.applyColourMatch([layer], self.getColourMatch(target))
+            mw.status_bar.showMessage("Colours matched...", 3000)
+        else:
+            mw.status_bar.showMessage(
+                "No active layer selected, activate a layer from the Layer Manager...", 4000)
+
+    def colourMatchAllSubmit(self):
+        # Match every layer except the one used as the target
+        target = self.getColourMatchTarget()
+        if target is None:
+            return
+        layers = [layer for layer in LayerManager.layers_container
+                  if layer is not self.colour_match_target.currentData()]
+        self.applyColourMatch(layers, self.getColourMatch(target))
+        mw.status_bar.showMessage("Colours matched...", 3000)
+
+    def applyColourMatch(self, layers, colour_match):
+        for layer in layers:
+            layer.ensureLoaded()
+        orig_matches = [layer.getColourMatch() for layer in layers]
+        ActionManager.colourMatchChanged(
+            layers, orig_matches, [colour_match] * len(layers))
+        for layer in layers:
+            layer.setColourMatch(colour_match)
+        # The colour transfer of each layer is done in parallel, the
+        # rest of the alterations reuse the results.
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(
+                lambda layer: layer.getColourMatchedImage(), layers))
+        for layer in layers:
+            layer.applyAlterations()
+
     def contrastSubmit(self):
         factor = self.contrast_param_factor.value()
         factor = factor/100
@@ -4480,9 +6022,7 @@ class MainWindow(qtw.QMainWindow):
         self.image_label.setPixmap(self.image)
 
 
-def alterRGB(image_name, r, g, b):
-    # Open the image in the provided file location
-    image = Image.open(str(project_path / image_name))
+def alterRGB(image, r, g, b):
     image = image.convert("RGBA")
 
     # Get the red, green and blue channel bands of the image
@@ -4499,12 +6039,36 @@ def alterRGB(image_name, r, g, b):
     source[G].paste(outG)
     source[B].paste(outB)
 
-    # Merge the channels together and replace the original image
+    # Merge the channels together over a copy of the original image,
+    # layer images may be shared so they are not changed in place
     rgb_image = Image.merge("RGB", (source[R], source[G], source[B]))
+    image = image.copy()
     image.paste(rgb_image, mask=image)
     return image
 
 
+def alterImage(image, rgb, bw, blur, sharpness, brightness, contrast):
+    # Apply a layer's alterations to an RGBA image
+    if rgb != [1, 1, 1]:
+        # alter rgb
+        image = alterRGB(image, rgb[0], rgb[1], rgb[2])
+    if bw == True:
+        # apply bw
+        image = makeLayerBaW(image)
+    if blur == True:
+        image = blurImage(image)
+    if sharpness != 1:
+        # apply sharpness
+        image = enhanceSharpness(image, sharpness)
+    if brightness != 1:
+        # apply brightness
+        image = enhanceBrightness(image, brightness)
+    if contrast != 1:
+        # apply contrast
+        image = enhanceContrast(image, contrast)
+    return image
+
+
 def createText(fontName, size, text, colour):
     font = ImageFont.truetype(fontName, int(size))
     # Create a blank image of size 0
@@ -4542,52 +6106,46 @@ def cropImage(image, startX, startY, endX, endY):
     return region
 
 
-def blurImage(image_name):
-    # Apply the blur filter to the specified image file
-    image = Image.open(str(project_path / image_name))
-    blur = image.copy().filter(ImageFilter.BLUR)
+def blurImage(image):
+    # Apply the blur filter to the provided image
+    blur = image.filter(ImageFilter.BLUR)
     return blur
 
 
-def enhanceContrast(image_name, factor):
+def enhanceContrast(image, factor):
     # Enhance the contrast of the provided image
     # using the provided factor.
-    image = Image.open(str(project_path / image_name))
-    image_enh = ImageEnhance.Contrast(image.copy())
+    image_enh = ImageEnhance.Contrast(image)
     enhanced_image = image_enh.enhance(factor)
     return enhanced_image
 
 
-def enhanceBrightness(image_name, factor):
+def enhanceBrightness(image, factor):
     # Enhance the brightness of the provided image
     # using the provided factor.
-    image = Image.open(str(project_path / image_name))
-    image_enh = ImageEnhance.Brightness(image.copy())
+    image_enh = ImageEnhance.Brightness(image)
     enhanced_image = image_enh.enhance(factor)
     return enhanced_image
 
 
-def enhanceColour(image_name, factor):
+def enhanceColour(image, factor):
     # Enhance the colour of the provided image
     # using the provided factor.
-    image = Image.open(str(project_path / image_name))
-    image_enh = ImageEnhance.Color(image.copy())
+    image_enh = ImageEnhance.Color(image)
     enhanced_image = image_enh.enhance(factor)
     return enhanced_image
 
 
-def enhanceSharpness(image_name, factor):
+def enhanceSharpness(image, factor):
     # Enhance the sharpness of the provided image
     # using the provided factor.
-    image = Image.open(str(project_path / image_name))
-    image_enh = ImageEnhance.Sharpness(image.copy())
+    image_enh = ImageEnhance.Sharpness(image)
     enhanced_image = image_enh.enhance(factor)
     return enhanced_image
 
 
-def makeLayerBaW(image_name):
+def makeLayerBaW(image):
     # Apply a black and white filter to the provided image
-    image = Image.open(str(project_path / image_name))
     image_alpha = image.split()[-1]
     grey = image.copy().convert("L")
     grey.convert("RGB")
@@ -4595,6 +6153,308 @@ def makeLayerBaW(image_name):
     return grey
 
 
+def applyMaskToImage(image, mask):
+    # Returns an RGBA copy of the image with its alpha channel
+    # multiplied by the 8-bit mask. A mask of None keeps the image.
+    if mask is None:
+        if image.mode == "RGBA":
+            return image
+        return image.convert("RGBA")
+    image = image.convert("RGBA")
+    image.putalpha(ImageChops.multiply(image.getchannel("A"), mask))
+    return image
+
+
+def writeImageEntry(archive, entry_name, image, format="PNG", **options):
+    # Stream an image into a zip archive entry. Image data is already
+    # compressed so the entry is stored as is.
+    with archive.open(zipfile.ZipInfo(entry_name), 'w',
+                      force_zip64=True) as entry:
+        image.save(entry, format=format, **options)
+
+
+def writeBytesEntry(archive, entry_name, data):
+    # Store encoded image data in a zip archive without re-encoding it
+    archive.writestr(zipfile.ZipInfo(entry_name), data)
+
+
+def writeProjectArchive(file_name, project_data, entries, append,
+                        check_cancelled=None):
+    # Write a project from its manifest data and entry writers. Entries
+    # are named by the SHA-1 of their content so an entry that is
+    # already in the file does not change. If append is True the file
+    # was written by this session and is unchanged since, then only the
+    # new entries and the next numbered manifest are appended to it.
+    # When more than half of the file is taken by entries that are no
+    # longer used, or the file is new, the used entries are written
+    # (copied from the old file without being encoded again) into a
+    # new file, which only replaces the project once it is complete.
+    # Either way a save that fails or is cancelled leaves the project
+    # as it was.
+    # check_cancelled is called between entries by background saves.
+    temp_file_name = file_name + ".tmp"
+    old_archive = None
+    try:
+        if append and zipfile.is_zipfile(file_name):
+            old_archive = zipfile.ZipFile(file_name)
+            old_entries = {info.filename: info.compress_size
+                           for info in old_archive.infolist()}
+            version = latestManifestVersion(old_entries) + 1
+            used = sum(size for name, size in old_entries.items()
+                       if name in entries)
+            if used * 2 >= sum(old_entries.values()):
+                old_archive.close()
+                old_archive = None
+                appendProjectArchive(file_name, project_data, entries,
+                                     version, check_cancelled)
+                return
+        else:
+            old_entries = {}
+            version = 1
+
+        with zipfile.ZipFile(temp_file_name, 'w') as archive:
+            for name, write_entry in entries.items():
+                if check_cancelled is not None:
+                    check_cancelled()
+                if name in old_entries:
+                    writeBytesEntry(archive, name, old_archive.read(name))
+                else:
+                    write_entry(archive)
+            writeManifestEntry(archive, version, project_data)
+        if old_archive is not None:
+            old_archive.close()
+            old_archive = None
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        removeFile(temp_file_name)
+        raise
+    finally:
+        if old_archive is not None:
+            old_archive.close()
+
+
+def appendProjectArchive(file_name, project_data, entries, version,
+                         check_cancelled=None):
+    # Append the entries that are not yet in a project file, then the
+    # manifest, in place. The new entries are written over the central
+    # directory at the end of the file, which is kept first. If the
+    # write fails or is cancelled the file is truncated back to where
+    # the directory started and it is written again, leaving the file
+    # as it was.
+    with open(file_name, 'r+b') as project_file:
+        archive = zipfile.ZipFile(project_file, 'a')
+        directory_start = archive.start_dir
+        project_file.seek(directory_start)
+        directory = project_file.read()
+        project_file.seek(directory_start)
+        old_entries = set(archive.namelist())
+        try:
+            for name, write_entry in entries.items():
+                if check_cancelled is not None:
+                    check_cancelled()
+                if name not in old_entries:
+                    write_entry(archive)
+            writeManifestEntry(archive, version, project_data)
+            archive.close()
+        except BaseException:
+            try:
+                archive.close()
+            except Exception:
+                pass
+            project_file.seek(directory_start)
+            project_file.truncate()
+            project_file.write(directory)
+            raise
+
+
+def autosave_task(task, file_name, snapshot, append):
+    # Background task writing an autosave from a project snapshot
+    project_data, entries = resolveProjectEntries(snapshot)
+    writeProjectArchive(file_name, project_data, entries, append,
+                        task.checkCancelled)
+
+
+class ProjectEntry():
+    # An image, preview or mask entry of a project snapshot. It holds
+    # the encoded data or the image of a layer, taken on the interface
+    # thread, and is named by the SHA-1 of its content when the
+    # snapshot is written. key is given when the layer already knows
+    # it. Previews are encoded in preview_format, those of decoded
+    # layers are given the displayed image and the reduced copy made
+    # from it by an earlier save, if there is one.
+
+    def __init__(self, folder, data=None, image=None, key=None,
+                 preview=False, reduced=None):
+        self.folder = folder
+        self.data = data
+        self.source = image
+        self.image = image if reduced is None else reduced
+        self.key = key
+        self.preview = preview
+        self.reduced = reduced
+
+    def getSource(self):
+        # Returns the layer's data or image the entry was taken from
+        return self.data if self.data is not None else self.source
+
+    def getImage(self):
+        return self.image
+
+    def getKey(self):
+        return self.key
+
+    def resolve(self):
+        # Returns the entry's name and the function that writes it
+        if self.data is not None:
+            if self.key is None:
+                self.key = ImageStore.key(self.data)
+            name = self.folder + '/' + self.key
+            return name, partial(writeBytesEntry, entry_name=name,
+                                 data=self.data)
+        if self.preview and self.reduced is None:
+            self.image = self.reduced = previewImage(self.source)
+        if self.key is None:
+            self.key = imageKey(self.image)
+        name = self.folder + '/' + self.key
+        if self.preview:
+            return name, partial(writeImageEntry, entry_name=name,
+                                 image=self.image, format=preview_format,
+                                 quality=80)
+        return name, partial(writeImageEntry, entry_name=name,
+                             image=self.image)
+
+
+def resolveProjectEntries(snapshot):
+    # Returns the manifest data of a project snapshot, with the name
+    # of each ProjectEntry in its place, and the entry names mapped to
+    # the functions that write them. Hashing and encoding is done here
+    # so autosaves do it on their worker thread.
+    entries = {}
+
+    def resolve(entry):
+        if entry is None:
+            return None
+        name, write_entry = entry.resolve()
+        entries[name] = write_entry
+        return name
+
+    project_data = dict(snapshot)
+    project_data['layers'] = []
+    for layer_data in snapshot['layers']:
+        layer_data = dict(layer_data)
+        for field in ('image', 'preview', 'mask'):
+            layer_data[field] = resolve(layer_data[field])
+        project_data['layers'].append(layer_data)
+    if 'preview' in snapshot:
+        project_data['preview'] = resolve(snapshot['preview'])
+    return project_data, entries
+
+
+def previewImage(image):
+    # Returns a copy of a layer's displayed image at half size, at most
+    # preview_size pixels across, which is stored in project files.
+    width, height = image.size
+    scale = min(0.5, preview_size / max(width, height))
+    return image.resize(
+        (max(1, round(width * scale)), max(1, round(height * scale))),
+        Image.BILINEAR)
+
+
+def writeManifestEntry(archive, version, project_data):
+    archive.writestr('manifests/' + str(version) + '.json',
+                     json.dumps(project_data),
+                     compress_type=zipfile.ZIP_DEFLATED)
+
+
+def latestManifestVersion(entry_names):
+    # Returns the number of the newest manifest in a project archive,
+    # 0 for projects saved with a single manifest.json
+    versions = [int(name[len('manifests/'):-len('.json')])
+                for name in entry_names
+                if name.startswith('manifests/') and name.endswith('.json')]
+    return max(versions, default=0)
+
+
+def removeFile(file_name):
+    # Remove the temporary file of a write that failed, if it was made
+    try:
+        os.remove(file_name)
+    except OSError:
+        pass
+
+
+def fileStamp(file_name):
+    # Returns the size and modification time of a file, or None when
+    # it does not exist
+    try:
+        stat = os.stat(file_name)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def imageKey(image):
+    # Returns the SHA-1 of an image's pixels
+    return ImageStore.key(str((image.mode, image.size)).encode() +
+                          image.tobytes())
+
+
+def decodeImageBytes(image_bytes):
+    # Decode an image held in memory in its encoded form
+    image = Image.open(BytesIO(image_bytes))
+    image.load()
+    return image
+
+
+def readSharedEntry(archive, entry_name, entries):
+    # Read a zip archive entry that may be shared by several layers,
+    # entries maps the names already read to their data.
+    if entry_name not in entries:
+        entries[entry_name] = archive.read(entry_name)
+    return entries[entry_name]
+
+
+def pixel_cache_evict_task(task):
+    # Background task trimming the pixel cache when the app starts
+    PixelCache.evict()
+
+
+def decodeProjectLayer(image_bytes, mask_bytes):
+    # Decode the image and mask of a project layer, run in a thread pool
+    # when a project is opened. Layers without an encoded image return
+    # (None, None).
+    if image_bytes is None:
+        return None, None
+    mask = None
+    if mask_bytes is not None:
+        mask = decodeImageBytes(mask_bytes).convert("L")
+    return ImageStore.decode(image_bytes, cache=True), mask
+
+
+def renderProjectLayer(images, properties):
+    # Returns the (cropped, mask, adjusted, altered) images of a layer
+    # from its decoded image and mask and its manifest entry, run in a
+    # thread pool when a project is opened. Layers without a decoded
+    # image return None.
+    image, mask = images
+    if image is None:
+        return None
+    colour_match = properties.get('colour match')
+    if colour_match is not None:
+        new_image = colour_transfer(
+            image, image_lab_statistics(image),
+            (colour_match['mean'], colour_match['std']),
+            colour_match['strength'])
+    else:
+        new_image = image.convert("RGBA")
+    adjusted_image = alterImage(
+        new_image, [properties['r'], properties['g'], properties['b']],
+        properties['bw'], properties['blur'], properties['sharpness'],
+        properties['brightness'], properties['contrast'])
+    return (image, mask, adjusted_image,
+            applyMaskToImage(adjusted_image, mask))
+
+
 def convertRGBtoHEX(color):
     # Convert an RGB array into a Hex string value
     return "#{:02x}{:02x}{:02x}".format(int(color[0]), int(color[1]), int(color[2]))
@@ -4605,6 +6465,23 @@ def convertHEXtoRGB(h):
     return tuple(int(h[i:i+2], 16) for i in (1, 3, 5))
 
 
+def convertImageToPixmap(image):
+    # Convert a PIL image into a QPixmap without writing it to a file
+    image = image.convert("RGBA")
+    data = image.tobytes("raw", "RGBA")
+    qimage = qtg.QImage(data, image.width, image.height,
+                        image.width * 4, qtg.QImage.Format_RGBA8888)
+    return qtg.QPixmap.fromImage(qimage)
+
+
+def convertQImageToImage(qimage):
+    # Convert a QImage into an RGBA PIL image without writing it to a file
+    qimage = qimage.convertToFormat(qtg.QImage.Format_RGBA8888)
+    data = qimage.constBits().asstring(qimage.sizeInBytes())
+    return Image.frombuffer("RGBA", (qimage.width(), qimage.height()),
+                            data, "raw", "RGBA", qimage.bytesPerLine(), 1)
+
+
 def convertRGBStrToTuple(rgb):
     # Convert an RGB string into an RGB array
     rgb = rgb.replace("(", "")
@@ -4614,53 +6491,990 @@ def convertRGBStrToTuple(rgb):
     return rgb
 
 
-def get_image(image_path):
-    # Get an image using the cv2 library
-    image = cv2.imread(image_path)
-    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-    return image
-
-
-def get_colours(image, number_of_colors, show_chart):
-    # Resize the image
-    resized_image = cv2.resize(
-        image, (500, 500), interpolation=cv2.INTER_AREA)
-    resized_image = resized_image.reshape(
-        resized_image.shape[0]*resized_image.shape[1], 3)
-
-    # Use K-Means clustering to get the most dominant colours
-    colours_kmeans = KMeans(n_clusters=number_of_colors)
-    colour_labels = colours_kmeans.fit_predict(resized_image)
-    counts = Counter(colour_labels)
-
-    center_colours = colours_kmeans.cluster_centers_
-    ordered_colours = [center_colours[i] for i in counts.keys()]
-    hex_colours = [convertRGBtoHEX(ordered_colours[i])
+def sample_pixels(image, max_pixels=250000, alpha_threshold=128):
+    # Returns up to max_pixels visible pixels of an RGB or RGBA image
+    # array as an (N, 3) array. Pixels with an alpha value below the
+    # threshold are skipped so the transparent area around a cutout is
+    # not counted. Every nth row and column is taken so the sample keeps
+    # the image's aspect ratio.
+    if image.shape[2] == 4:
+        visible = image[:, :, 3] >= alpha_threshold
+        num_visible = np.count_nonzero(visible)
+    else:
+        visible = None
+        num_visible = image.shape[0] * image.shape[1]
+    step = max(1, math.ceil(math.sqrt(num_visible / max_pixels)))
+    sample = image[::step, ::step, :3]
+    if visible is None:
+        return sample.reshape(-1, 3)
+    return sample[visible[::step, ::step]]
+
+
+def colour_histogram_bins(pixels, bits=5):
+    # Reduces an (N, 3) array of RGB pixels to a coarse 3D colour
+    # histogram with 2^bits bins per channel. Returns the index, the
+    # mean colour and the pixel count of each occupied bin.
+    quantised = (pixels >> (8 - bits)).astype(np.int32)
+    bins = (quantised[:, 0] << (2 * bits)) | (
+        quantised[:, 1] << bits) | quantised[:, 2]
+    counts = np.bincount(bins, minlength=1 << (3 * bits))
+    occupied = np.nonzero(counts)[0]
+    colours = np.empty((len(occupied), 3), dtype=np.float64)
+    for channel in range(3):
+        channel_sums = np.bincount(bins, weights=pixels[:, channel],
+                                   minlength=1 << (3 * bits))
+        colours[:, channel] = channel_sums[occupied] / counts[occupied]
+    return occupied, colours, counts[occupied].astype(np.float64)
+
+
+def colour_histogram(pixels, bits=5):
+    # Returns the mean colour and the pixel count of each occupied bin
+    # of a coarse colour histogram, see colour_histogram_bins.
+    return colour_histogram_bins(pixels, bits)[1:]
+
+
+def weighted_kmeans(points, weights, k, initial_centres=None, iterations=30):
+    # K-Means clustering where each point carries a weight, used to
+    # cluster histogram bins rather than individual pixels. If initial
+    # centres are provided (e.g. a previous palette) they are used as
+    # the starting point, otherwise k-means++ seeding is used.
+    k = min(k, len(points))
+    if initial_centres is not None and len(initial_centres) == k:
+        centres = np.array(initial_centres, dtype=np.float64)
+    else:
+        # k-means++ seeding, weighted by pixel counts. A fixed seed keeps
+        # the palette the same each time it is generated.
+        rng = np.random.default_rng(0)
+        centres = [points[np.argmax(weights)]]
+        distances = ((points - centres[0]) ** 2).sum(axis=1)
+        for i in range(1, k):
+            probabilities = distances * weights
+            if probabilities.sum() == 0:
+                break
+            choice = rng.choice(len(points), p=probabilities / probabilities.sum())
+            centres.append(points[choice])
+            distances = np.minimum(
+                distances, ((points - points[choice]) ** 2).sum(axis=1))
+        centres = np.array(centres)
+
+    # Squared distances are expanded as |p|^2 - 2 p.c + |c|^2 so only
+    # an N x k array is built rather than N x k x 3 differences.
+    point_norms = (points ** 2).sum(axis=1)[:, None]
+
+    def nearest(centres):
+        distances = point_norms - 2 * points @ centres.T + \
+            (centres ** 2).sum(axis=1)[None, :]
+        return np.argmin(distances, axis=1)
+
+    for i in range(iterations):
+        labels = nearest(centres)
+        cluster_weights = np.bincount(labels, weights=weights,
+                                      minlength=len(centres))
+        new_centres = centres.copy()
+        occupied = cluster_weights > 0
+        for channel in range(3):
+            channel_sums = np.bincount(labels, weights=points[:, channel] * weights,
+                                       minlength=len(centres))
+            new_centres[occupied, channel] = channel_sums[occupied] / \
+                cluster_weights[occupied]
+        shift = np.abs(new_centres - centres).max()
+        centres = new_centres
+        if shift < 0.5:
+            break
+
+    cluster_weights = np.bincount(nearest(centres), weights=weights,
+                                  minlength=len(centres))
+    return centres, cluster_weights
+
+
+def palette_task(task, image, number_of_colours, previous_colours):
+    # Background task used to compute a layer's palette ahead of time
+    task.checkCancelled()
+    return get_colours(np.asarray(image), number_of_colours, False,
+                       previous_colours)
+
+
+def get_colours(image, number_of_colors, show_chart, previous_colours=None):
+    # Reduce the visible pixels of the image to a coarse colour
+    # histogram so that the clustering works on a few thousand occupied
+    # bins instead of every pixel.
+    colours, counts = colour_histogram(sample_pixels(image))
+    if len(colours) == 0:
+        # The image is completely transparent
+        return []
+
+    return palette_from_histogram(colours, counts, number_of_colors,
+                                  previous_colours)
+
+
+def get_document_colours(histogram, layers, width, height,
+                         number_of_colours, previous_colours=None):
+    # Returns the palette of a stack of layers as seen in a width x
+    # height canvas, histogram is the DocumentHistogram kept for it.
+    colours, weights = histogram.update(layers, width, height)
+    if len(colours) == 0:
+        return []
+    return palette_from_histogram(colours, weights, number_of_colours,
+                                  previous_colours)
+
+
+class DocumentHistogram():
+    # The combined colour histogram of a stack of layers as seen in the
+    # canvas, held as the weights and colour sums of every bin of the
+    # coarse histogram. Each layer's cached histogram is added weighted
+    # by the area of the layer left visible by the layers above it,
+    # which is measured on a small copy of the canvas. When the canvas
+    # changes only the layers whose pixels or visible area changed are
+    # subtracted and added again.
+
+    def __init__(self, bits=5, coverage_size=128):
+        self.coverage_size = coverage_size
+        self.counts = np.zeros(1 << (3 * bits), dtype=np.float64)
+        self.sums = np.zeros((1 << (3 * bits), 3), dtype=np.float64)
+        # The histogram, pixel version and weight each layer was added
+        # with, by layer.
+        self.contributions = {}
+
+    def add(self, histogram, weight):
+        bins, colours, counts = histogram
+        self.counts[bins] += counts * weight
+        self.sums[bins] += colours * (counts * weight)[:, None]
+
+    def update(self, layers, width, height):
+        # Brings the histogram up to date with the layers and returns
+        # the mean colour and weight of each occupied bin.
+        scale = self.coverage_size / max(width, height)
+        coverage_width = max(1, round(width * scale))
+        coverage_height = max(1, round(height * scale))
+        uncovered = np.ones((coverage_height, coverage_width),
+                            dtype=np.float32)
+
+        contributions = {}
+        for layer in sorted(layers, key=lambda layer: layer.getZPosition(),
+                            reverse=True):
+            alpha = layer.renderCoverage(scale, coverage_width,
+                                         coverage_height)
+            visible_area = float((alpha * uncovered).sum())
+            uncovered *= 1 - alpha
+            histogram = layer.getHistogramBins()
+            total = histogram[2].sum()
+            weight = visible_area / total if total > 0 else 0
+            contributions[layer] = (histogram, layer.getPixelVersion(),
+                                    weight)
+
+        for layer, (histogram, version, weight) in self.contributions.items():
+            current = contributions.get(layer)
+            if current is None or current[1:] != (version, weight):
+                self.add(histogram, -weight)
+        for layer, (histogram, version, weight) in contributions.items():
+            previous = self.contributions.get(layer)
+            if previous is None or previous[1:] != (version, weight):
+                self.add(histogram, weight)
+        self.contributions = contributions
+        if not contributions:
+            # Start again from zero so rounding errors do not build up
+            self.counts[:] = 0
+            self.sums[:] = 0
+
+        # Bins emptied by subtraction keep tiny rounding errors
+        occupied = np.nonzero(self.counts > 1e-9 * self.counts.max(initial=0))[0]
+        weights = self.counts[occupied]
+        return self.sums[occupied] / weights[:, None], weights
+
+
+def palette_from_histogram(colours, counts, number_of_colors,
+                           previous_colours=None):
+    # Use weighted K-Means clustering to get the most dominant colours,
+    # starting from the previous palette of the image if there is one.
+    initial_centres = None
+    if previous_colours:
+        initial_centres = [convertHEXtoRGB(colour)
+                           for colour in previous_colours]
+    center_colours, colour_weights = weighted_kmeans(
+        colours, counts, number_of_colors, initial_centres)
+
+    # Order the colours from most to least dominant
+    ordered_colours = center_colours[np.argsort(-colour_weights)]
+    hex_colours = [convertRGBtoHEX(np.round(ordered_colours[i]))
                    for i in range(0, len(ordered_colours))]
 
     return hex_colours
 
 
-def gradient_array_channel(start, stop, width, height, horizontal_bool):
-    if horizontal_bool:
-        return np.tile(np.linspace(start, stop, width), (height, 1))
+# sRGB (D65) to CIE XYZ conversion matrix and the D65 white point
+rgb_to_xyz_matrix = np.array([[0.4124, 0.3576, 0.1805],
+                              [0.2126, 0.7152, 0.0722],
+                              [0.0193, 0.1192, 0.9505]], dtype=np.float32)
+xyz_white = np.array([0.9505, 1.0, 1.089], dtype=np.float32)
+xyz_to_rgb_matrix = np.linalg.inv(rgb_to_xyz_matrix).astype(np.float32)
+linear_levels = np.arange(16384, dtype=np.float32) / 16383
+linear_to_srgb_lut = np.round(255 * np.where(
+    linear_levels > 0.0031308, 1.055 * linear_levels ** (1 / 2.4) - 0.055,
+    linear_levels * 12.92)).astype(np.uint8)
+srgb_levels = np.arange(256, dtype=np.float32) / 255
+srgb_to_linear_lut = np.where(srgb_levels > 0.04045,
+                              ((srgb_levels + 0.055) / 1.055) ** 2.4,
+                              srgb_levels / 12.92).astype(np.float32)
+
+
+def rgb_to_lab(rgb):
+    # Convert an array of sRGB colours (0-255) in its last axis to
+    # CIELAB. 8-bit pixels are linearised through a lookup table.
+    if rgb.dtype == np.uint8:
+        linear = srgb_to_linear_lut[rgb]
     else:
-        return np.tile(np.linspace(start, stop, height), (width, 1)).T
-
-
-def gradient_array(width, height, start_list, stop_list, horizontal_bool):
-    # Create an array populate with zeros
-    gradient_array = np.zeros((height, width, len(start_list)), dtype=np.float64)
-
-    for i, (start, stop, horizontal_bool) in enumerate(zip(start_list, stop_list, horizontal_bool)):
-        gradient_array[:, :, i] = gradient_array_channel(
-            start, stop, width, height, horizontal_bool)
-
-    return gradient_array
+        srgb = np.asarray(rgb, dtype=np.float32) / 255
+        linear = np.where(srgb > 0.04045, ((srgb + 0.055) / 1.055) ** 2.4,
+                          srgb / 12.92)
+    xyz = (linear @ rgb_to_xyz_matrix.T) / xyz_white
+    f = np.where(xyz > 0.008856, np.cbrt(xyz), 7.787 * xyz + 16 / 116)
+    lab = np.empty_like(f)
+    lab[..., 0] = 116 * f[..., 1] - 16
+    lab[..., 1] = 500 * (f[..., 0] - f[..., 1])
+    lab[..., 2] = 200 * (f[..., 1] - f[..., 2])
+    return lab
+
+
+def lab_to_rgb(lab):
+    # Convert an array of CIELAB colours to sRGB uint8 values
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([fy + lab[..., 1] / 500, fy, fy - lab[..., 2] / 200], axis=-1)
+    xyz = np.where(f > 0.206893, f ** 3, (f - 16 / 116) / 7.787) * xyz_white
+    linear = np.clip(xyz @ xyz_to_rgb_matrix.T, 0, 1)
+    # Encode through a lookup table indexed by the quantised linear value
+    return linear_to_srgb_lut[(linear * 16383 + 0.5).astype(np.uint16)]
+
+
+def image_lab_statistics(image):
+    # Returns the CIELAB mean and standard deviation of an image's
+    # visible pixels
+    colours, counts = colour_histogram(sample_pixels(
+        np.asarray(image.convert("RGBA"))))
+    return lab_statistics(colours, counts)
+
+
+def lab_statistics(colours, weights=None):
+    # Returns the CIELAB mean and standard deviation of a set of
+    # colours, optionally weighted (e.g. by histogram counts).
+    lab = rgb_to_lab(colours)
+    mean = np.average(lab, axis=0, weights=weights)
+    std = np.sqrt(np.average((lab - mean) ** 2, axis=0, weights=weights))
+    return mean.tolist(), std.tolist()
+
+
+def colour_transfer(image, source, target, strength=1, strip_rows=256):
+    # Reinhard colour transfer: each CIELAB channel of the image is
+    # shifted and scaled so that its mean and standard deviation move
+    # from the source statistics towards the target statistics. The
+    # strength (0-1) sets how far they are moved. Rows are converted a
+    # strip at a time and the alpha channel is kept.
+    source_mean = np.array(source[0], dtype=np.float32)
+    source_std = np.array(source[1], dtype=np.float32)
+    target_mean = source_mean + strength * (np.array(target[0]) - source_mean)
+    target_std = source_std + strength * (np.array(target[1]) - source_std)
+    gain = (target_std / np.maximum(source_std, 1e-3)).astype(np.float32)
+    offset = (target_mean - source_mean * gain).astype(np.float32)
+
+    pixels = np.asarray(image.convert("RGBA"))
+    output = pixels.copy()
+    for row in range(0, pixels.shape[0], strip_rows):
+        lab = rgb_to_lab(pixels[row:row+strip_rows, :, :3])
+        output[row:row+strip_rows, :, :3] = lab_to_rgb(lab * gain + offset)
+    return Image.fromarray(output, "RGBA")
+
+
+def rasterizePaths(paths, width, height, fill_rule):
+    # Fills every path into a single boolean array in one pass. Where
+    # paths overlap the fill rule (qtc.Qt.OddEvenFill or
+    # qtc.Qt.WindingFill) decides whether the area is a hole.
+    painter_path = qtg.QPainterPath()
+    painter_path.setFillRule(fill_rule)
+    for path in paths:
+        painter_path.addPolygon(qtg.QPolygonF(
+            [qtc.QPointF(x, y) for x, y in path]))
+        painter_path.closeSubpath()
+
+    mask_image = qtg.QImage(width, height, qtg.QImage.Format_Grayscale8)
+    mask_image.fill(0)
+    painter = qtg.QPainter(mask_image)
+    painter.setPen(qtc.Qt.NoPen)
+    painter.setBrush(qtg.QColor(255, 255, 255))
+    painter.drawPath(painter_path)
+    painter.end()
+
+    data = mask_image.constBits().asstring(mask_image.sizeInBytes())
+    mask = np.frombuffer(data, dtype=np.uint8).reshape(
+        height, mask_image.bytesPerLine())[:, :width]
+    return mask > 127
+
+
+def auto_cutout_task(task, image, mask, seed_box, seed_paths):
+    # Background task running the automatic cutout on a layer image
+    # with its current mask applied.
+    image = np.array(applyMaskToImage(image, mask))
+    return auto_cutout_mask(task, image, seed_box, seed_paths)
+
+
+def auto_cutout_mask(task, image, seed_box, seed_paths, working_size=400,
+                     iterations=5, tile_size=256):
+    # Separates the foreground object from the background of an RGBA
+    # image array using GrabCut. The seed is either a box (x0, y0, x1, y1)
+    # around the object or paths of (x, y) points traced around it.
+    # GrabCut is run on a downscaled copy of the image and the resulting
+    # mask is upsampled, only the band of pixels along the mask boundary
+    # is then refined at full resolution. Returns a uint8 mask where 255
+    # marks the foreground. The task is used to report progress and
+    # stop early when the user cancels.
+    height, width = image.shape[:2]
+    rgb = np.ascontiguousarray(image[:, :, :3])
+    transparent = image[:, :, 3] == 0
+
+    # Build the initial full size seed mask, everything outside the
+    # seed is background and everything inside is probably foreground.
+    seed_mask = np.full((height, width), cv2.GC_BGD, dtype=np.uint8)
+    if seed_box is not None:
+        x0, y0, x1, y1 = [int(round(v)) for v in seed_box]
+        x0, x1 = max(0, min(x0, width)), max(0, min(x1, width))
+        y0, y1 = max(0, min(y0, height)), max(0, min(y1, height))
+        seed_mask[y0:y1, x0:x1] = cv2.GC_PR_FGD
+    else:
+        polygons = [np.round(np.array(path)).astype(np.int32)
+                    for path in seed_paths]
+        cv2.fillPoly(seed_mask, polygons, cv2.GC_PR_FGD)
+    # Pixels that are already transparent can never be foreground.
+    seed_mask[transparent] = cv2.GC_BGD
+    if not np.any(seed_mask == cv2.GC_PR_FGD):
+        raise ValueError("The seed does not cover any visible pixels")
+
+    # Run the coarse segmentation on a downscaled copy of the image.
+    scale = min(1.0, working_size / max(width, height))
+    small_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    small_rgb = cv2.resize(rgb, small_size, interpolation=cv2.INTER_AREA)
+    small_mask = cv2.resize(seed_mask, small_size,
+                            interpolation=cv2.INTER_NEAREST)
+    # GrabCut needs background samples. A seed covering the whole
+    # visible image, such as a box dragged past its edges, leaves a one
+    # pixel border of the working copy as background.
+    if not np.any(small_mask == cv2.GC_BGD):
+        small_mask[[0, -1], :] = cv2.GC_BGD
+        small_mask[:, [0, -1]] = cv2.GC_BGD
+    if not np.any(small_mask == cv2.GC_PR_FGD):
+        raise ValueError("The seed does not cover enough of the image")
+    bgd_model = np.zeros((1, 65), np.float64)
+    fgd_model = np.zeros((1, 65), np.float64)
+    for i in range(iterations):
+        task.checkCancelled()
+        mode = cv2.GC_INIT_WITH_MASK if i == 0 else cv2.GC_EVAL
+        cv2.grabCut(small_rgb, small_mask, None,
+                    bgd_model, fgd_model, 1, mode)
+        task.setProgress(50 * (i + 1) / iterations)
+
+    small_foreground = np.where(
+        (small_mask == cv2.GC_FGD) | (small_mask == cv2.GC_PR_FGD), 255, 0).astype(np.uint8)
+    foreground = cv2.resize(small_foreground, (width, height),
+                            interpolation=cv2.INTER_LINEAR)
+    foreground = np.where(foreground > 127, 255, 0).astype(np.uint8)
+    foreground[transparent] = 0
+    if scale == 1.0:
+        task.setProgress(100)
+        return foreground
+
+    # The upsampled mask is only uncertain within a few source pixels of
+    # its boundary. Pixels in this band are refined at full resolution,
+    # tile by tile so that tiles without any boundary are skipped.
+    band_radius = int(math.ceil(1 / scale)) + 1
+    kernel = np.ones((2 * band_radius + 1, 2 * band_radius + 1), np.uint8)
+    band = cv2.dilate(foreground, kernel) != cv2.erode(foreground, kernel)
+    band &= ~transparent
+
+    refine_mask = np.where(foreground == 255, cv2.GC_FGD,
+                           cv2.GC_BGD).astype(np.uint8)
+    refine_mask[band & (foreground == 255)] = cv2.GC_PR_FGD
+    refine_mask[band & (foreground == 0)] = cv2.GC_PR_BGD
+
+    tiles = []
+    for tile_y in range(0, height, tile_size):
+        for tile_x in range(0, width, tile_size):
+            if band[tile_y:tile_y+tile_size, tile_x:tile_x+tile_size].any():
+                tiles.append((tile_x, tile_y))
+
+    for i, (tile_x, tile_y) in enumerate(tiles):
+        task.checkCancelled()
+        # Each tile is padded with a margin so GrabCut has enough
+        # surrounding colour information to model both regions.
+        x0 = max(0, tile_x - band_radius)
+        y0 = max(0, tile_y - band_radius)
+        x1 = min(width, tile_x + tile_size + band_radius)
+        y1 = min(height, tile_y + tile_size + band_radius)
+        tile_mask = refine_mask[y0:y1, x0:x1].copy()
+        is_foreground = (tile_mask == cv2.GC_FGD) | (tile_mask == cv2.GC_PR_FGD)
+        if is_foreground.all() or not is_foreground.any():
+            continue
+        tile_rgb = np.ascontiguousarray(rgb[y0:y1, x0:x1])
+        cv2.grabCut(tile_rgb, tile_mask, None, np.zeros((1, 65), np.float64),
+                    np.zeros((1, 65), np.float64), 2, cv2.GC_INIT_WITH_MASK)
+
+        # Only the unpadded part of the tile is written back.
+        inner = (slice(tile_y - y0, tile_y - y0 + tile_size),
+                 slice(tile_x - x0, tile_x - x0 + tile_size))
+        tile_foreground = (tile_mask[inner] == cv2.GC_FGD) | (
+            tile_mask[inner] == cv2.GC_PR_FGD)
+        tile_band = band[tile_y:tile_y+tile_size, tile_x:tile_x+tile_size]
+        region = foreground[tile_y:tile_y+tile_size, tile_x:tile_x+tile_size]
+        region[tile_band] = np.where(tile_foreground[tile_band], 255, 0)
+        task.setProgress(50 + 50 * (i + 1) / len(tiles))
+
+    task.setProgress(100)
+    return foreground
+
+
+def gradient_lut(stops):
+    # Returns a 256 x 3 uint8 table of the colours along the gradient,
+    # stops are [position, [r, g, b]] pairs with positions from 0 to 1.
+    stops = sorted(stops, key=lambda stop: stop[0])
+    positions = [stop[0] for stop in stops]
+    samples = np.linspace(0, 1, 256)
+    lut = np.empty((256, 3), dtype=np.uint8)
+    for channel in range(3):
+        values = [stop[1][channel] for stop in stops]
+        lut[:, channel] = np.round(np.interp(samples, positions, values))
+    return lut
+
+
+def render_gradient(gradient, width, height, box=None, strip_rows=128):
+    # Rasterize a gradient stretched over width x height pixels. Only
+    # the pixels inside box (x0, y0, x1, y1) are produced, so a tile of
+    # a large output can be rendered on its own. Each pixel is mapped
+    # to an index into the colour table; the indexes are computed a
+    # strip of rows at a time so no full size float array is needed.
+    if box is None:
+        box = (0, 0, width, height)
+    x0, y0, x1, y1 = box
+    lut = gradient_lut(gradient['stops'])
+    output = np.empty((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+    # Pixel centres of the output columns and rows
+    xs = np.arange(x0, x1, dtype=np.float32) + 0.5
+    ys = np.arange(y0, y1, dtype=np.float32) + 0.5
+
+    if gradient['kind'] == 'radial':
+        # The gradient runs from the centre to the furthest corner
+        cx = width * gradient.get('centre', (0.5, 0.5))[0]
+        cy = height * gradient.get('centre', (0.5, 0.5))[1]
+        radius = max(math.hypot(cx - x, cy - y)
+                     for x in (0, width) for y in (0, height))
+        radius *= gradient.get('radius', 1)
+        dx2 = ((xs - cx) * (255 / radius)) ** 2
+        dy2 = ((ys - cy) * (255 / radius)) ** 2
+        for row in range(0, len(ys), strip_rows):
+            distance = np.sqrt(dx2[None, :] + dy2[row:row+strip_rows, None])
+            index = np.minimum(distance, 255).astype(np.uint8)
+            output[row:row+strip_rows] = lut[index]
+    else:
+        angle = math.radians(gradient.get('angle', 90))
+        dx, dy = math.cos(angle), math.sin(angle)
+        # Project the canvas corners onto the gradient direction to
+        # find where the gradient starts and ends.
+        projections = [x * dx + y * dy for x in (0, width) for y in (0, height)]
+        start = min(projections)
+        scale = 255 / max(max(projections) - start, 1e-6)
+        if abs(dy) < 1e-6 or abs(dx) < 1e-6:
+            # Axis aligned gradients only vary along one axis, a single
+            # row or column of colours is broadcast over the output.
+            if abs(dy) < 1e-6:
+                index = np.clip((xs * dx - start) * scale, 0, 255)
+                output[:] = lut[index.astype(np.uint8)][None, :, :]
+            else:
+                index = np.clip((ys * dy - start) * scale, 0, 255)
+                output[:] = lut[index.astype(np.uint8)][:, None, :]
+        else:
+            xp = (xs * dx - start) * scale
+            yp = ys * dy * scale
+            for row in range(0, len(ys), strip_rows):
+                index = np.clip(xp[None, :] + yp[row:row+strip_rows, None],
+                                0, 255).astype(np.uint8)
+                output[row:row+strip_rows] = lut[index]
+
+    return Image.fromarray(output)
+
+
+def writeCanvasImages(targets, layers, width, height, check_cancelled=None,
+                      set_progress=None):
+    # Write the layers composited over the width x height canvas to
+    # each target, a (file name, image width, format, options) tuple
+    # where options are the format's save options as named by Pillow.
+    # The images are rendered and written a strip of rows at a time,
+    # only a strip of each PNG or TIFF is held in memory. An image at
+    # most half the width of another is reduced from the strips of the
+    # larger one rather than composited from the layers again, the
+    # area average of the larger image's pixels is as good a reduction
+    # as the layer resampling. The images are written to temporary
+    # files which replace the targets once all of them are complete.
+    # check_cancelled is called between strips by background exports
+    # and set_progress is given the percentage of strips rendered.
+    writer_types = {"PNG": PNGStripWriter,
+                    "TIFF": TIFFStripWriter,
+                    "JPEG": partial(PillowStripWriter, format="JPEG"),
+                    "WEBP": partial(PillowStripWriter, format="WEBP")}
+    targets = sorted(targets, key=lambda target: target[1], reverse=True)
+    files = []
+    try:
+        # Images are (width, height, writers) triples, the writers of
+        # an image include the reductions built from it. Only the
+        # composited images are rendered, the reductions are fed by
+        # their source.
+        images, composited = [], []
+        for file_name, output_width, format, options in targets:
+            output_height = max(1, round(height * output_width / width))
+            files.append(open(file_name + ".tmp", "wb"))
+            writers = [writer_types[format](files[-1], output_width,
+                                            output_height, **options)]
+            sources = [image for image in images
+                       if image[0] >= 2 * output_width]
+            if sources:
+                # The smallest source needs the least reduction
+                source_width, source_height, source_writers = sources[-1]
+                source_writers.append(StripReducer(
+                    source_width, source_height, output_width,
+                    output_height, writers))
+            else:
+                composited.append((output_width, output_height, writers))
+            images.append((output_width, output_height, writers))
+
+        rows = sum(output_height for _, output_height, _ in composited)
+        rows_done = 0
+        for output_width, output_height, writers in composited:
+            scale = output_width / width
+            cache = LayerRasterCache(export_cache_limit)
+            for top in range(0, output_height, export_strip_rows):
+                if check_cancelled is not None:
+                    check_cancelled()
+                bottom = min(top + export_strip_rows, output_height)
+                strip = composite_layers(layers, width, height, scale,
+                                         (0, top, output_width, bottom),
+                                         cache=cache)
+                strip = np.asarray(strip.convert("RGB"))
+                for writer in writers:
+                    writer.write(strip)
+                rows_done += bottom - top
+                if set_progress is not None:
+                    set_progress(100 * rows_done / rows)
+            for writer in writers:
+                writer.close()
+        for file in files:
+            file.close()
+        for file, target in zip(files, targets):
+            os.replace(file.name, target[0])
+    except BaseException:
+        # Targets already replaced have no temporary file left
+        for file in files:
+            file.close()
+            removeFile(file.name)
+        raise
+
+
+def export_task(task, targets, layers, width, height):
+    # Background task writing exported images from a layer snapshot
+    writeCanvasImages(targets, layers, width, height, task.checkCancelled,
+                      task.setProgress)
+
+
+class PillowStripWriter():
+    # Writes an image in a format Pillow only encodes as a whole, such
+    # as JPEG or WebP. The strips are gathered into one array which is
+    # encoded by close, so these images are held in memory in full.
+    # options are passed to Image.save.
+    size_limits = {"JPEG": 65535, "WEBP": 16383}
+
+    def __init__(self, file, width, height, format, **options):
+        if max(width, height) > PillowStripWriter.size_limits.get(format, 2 ** 31):
+            raise ValueError("Image is too large to save as a " + format + " file")
+        self.file = file
+        self.format = format
+        self.options = options
+        self.pixels = np.empty((height, width, 3), dtype=np.uint8)
+        self.next_row = 0
+
+    def write(self, strip):
+        self.pixels[self.next_row:self.next_row + len(strip)] = strip
+        self.next_row += len(strip)
+
+    def close(self):
+        Image.fromarray(self.pixels).save(self.file, self.format,
+                                          **self.options)
+
+
+class StripReducer():
+    # Reduces an image arriving in strips of rows to a smaller size by
+    # averaging the area of the image under each output pixel. Output
+    # rows are passed on to the writers as soon as the rows they cover
+    # have arrived, the rows still needed are kept until then.
+
+    def __init__(self, width, height, output_width, output_height,
+                 writers):
+        self.width = width
+        self.height = height
+        self.output_width = output_width
+        self.output_height = output_height
+        self.writers = writers
+        self.rows = np.zeros((0, width, 3), dtype=np.uint8)
+        # Row of the full image held in self.rows[0]
+        self.first_row = 0
+        self.next_output_row = 0
+
+    def write(self, strip):
+        self.rows = np.concatenate([self.rows, strip])
+        available = self.first_row + len(self.rows)
+        end = available * self.output_height // self.height
+        if end > self.next_output_row:
+            y_scale = self.height / self.output_height
+            image = Image.fromarray(self.rows).resize(
+                (self.output_width, end - self.next_output_row), Image.BOX,
+                box=(0, self.next_output_row * y_scale - self.first_row,
+                     self.width, end * y_scale - self.first_row))
+            output = np.asarray(image)
+            for writer in self.writers:
+                writer.write(output)
+            self.next_output_row = end
+        used = self.next_output_row * self.height // self.output_height
+        self.rows = self.rows[used - self.first_row:]
+        self.first_row = used
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+
+class PNGStripWriter():
+    # Writes an RGB PNG file from strips of rows. Every row is stored
+    # as its difference from the row above (PNG filter type 2) and the
+    # rows form one zlib stream, split into IDAT chunks as it is
+    # compressed.
+
+    def __init__(self, file, width, height, compress_level=6):
+        self.file = file
+        self.compressor = zlib.compressobj(compress_level)
+        self.previous_row = np.zeros(width * 3, dtype=np.uint8)
+        file.write(b"\x89PNG\r\n\x1a\n")
+        self.writeChunk(b"IHDR", struct.pack(">IIBBBBB", width, height,
+                                             8, 2, 0, 0, 0))
+
+    def writeChunk(self, chunk_type, data):
+        self.file.write(struct.pack(">I", len(data)) + chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type))))
+
+    def write(self, strip):
+        rows = strip.reshape(strip.shape[0], -1)
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 2
+        filtered[0, 1:] = rows[0] - self.previous_row
+        filtered[1:, 1:] = rows[1:] - rows[:-1]
+        self.previous_row = rows[-1].copy()
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self.writeChunk(b"IDAT", data)
+
+    def close(self):
+        self.writeChunk(b"IDAT", self.compressor.flush())
+        self.writeChunk(b"IEND", b"")
+
+
+class TIFFStripWriter():
+    # Writes an RGB TIFF file from strips of rows, which are stored in
+    # strips of export_strip_rows rows. Each strip is deflate
+    # compressed with horizontal differencing (predictor 2) and
+    # written once its rows have arrived, the directory listing where
+    # the strips are is written after them.
+
+    def __init__(self, file, width, height, compress_level=6):
+        self.file = file
+        self.width = width
+        self.height = height
+        self.compress_level = compress_level
+        self.rows = np.zeros((0, width, 3), dtype=np.uint8)
+        self.strip_offsets = []
+        self.strip_byte_counts = []
+        # Little endian header, the directory offset is filled in by close
+        file.write(b"II*\x00\x00\x00\x00\x00")
+
+    def write(self, strip):
+        self.rows = np.concatenate([self.rows, strip])
+        while len(self.rows) >= export_strip_rows:
+            self.writeStrip(self.rows[:export_strip_rows])
+            self.rows = self.rows[export_strip_rows:]
+
+    def writeStrip(self, strip):
+        differences = strip.copy()
+        differences[:, 1:] -= strip[:, :-1]
+        data = zlib.compress(differences.tobytes(), self.compress_level)
+        self.checkOffset(self.file.tell() + len(data))
+        self.strip_offsets.append(self.file.tell())
+        self.strip_byte_counts.append(len(data))
+        self.file.write(data)
+
+    def close(self):
+        if len(self.rows):
+            self.writeStrip(self.rows)
+        short, long = 3, 4
+        entries = [(256, long, [self.width]),
+                   (257, long, [self.height]),
+                   (258, short, [8, 8, 8]),
+                   (259, short, [8]),
+                   (262, short, [2]),
+                   (273, long, self.strip_offsets),
+                   (277, short, [3]),
+                   (278, long, [export_strip_rows]),
+                   (279, long, self.strip_byte_counts),
+                   (284, short, [1]),
+                   (317, short, [2])]
+        # Values that do not fit in their entry are written before
+        # the directory.
+        fields = []
+        for tag, field_type, values in entries:
+            data = struct.pack("<%d%s" % (len(values), "H" if field_type == short else "I"),
+                               *values)
+            if len(data) > 4:
+                offset = self.wordAlign()
+                self.file.write(data)
+                data = struct.pack("<I", offset)
+            fields.append(struct.pack("<HHI", tag, field_type, len(values)) +
+                          data.ljust(4, b"\x00"))
+        directory_offset = self.wordAlign()
+        self.file.write(struct.pack("<H", len(fields)) + b"".join(fields) +
+                        struct.pack("<I", 0))
+        self.file.seek(4)
+        self.file.write(struct.pack("<I", directory_offset))
+
+    def wordAlign(self):
+        # Offsets in a TIFF file must be even
+        if self.file.tell() % 2:
+            self.file.write(b"\x00")
+        self.checkOffset(self.file.tell())
+        return self.file.tell()
+
+    def checkOffset(self, offset):
+        # Offsets in a TIFF file are 32 bit, an image that does not fit
+        # is stopped before any offset is packed.
+        if offset >= 2 ** 32:
+            raise ValueError("Image is too large to save as a TIFF file")
+
+
+class CanvasLayerSource():
+    # The pixels of a layer as composited by composite_layers, taken
+    # from the layer on the interface thread. A gradient that has not
+    # been altered or cut is kept as its parameters and rendered at the
+    # size it is drawn in the output, so it stays smooth in exports
+    # larger than the canvas. A layer that has not been decoded is
+    # given as its encoded (image, mask) and its alterations, and is
+    # decoded by the first strip that needs it.
+
+    def __init__(self, size, image=None, gradient=None, encoded=None,
+                 properties=None):
+        self.size = size
+        self.image = image
+        self.gradient = gradient
+        self.encoded = encoded
+        self.properties = properties
+
+    def getSize(self):
+        return self.size
+
+    def isParametric(self):
+        return self.gradient is not None
+
+    def getImage(self):
+        if self.image is None:
+            self.image = renderProjectLayer(
+                decodeProjectLayer(*self.encoded), self.properties)[3]
+            self.encoded = None
+        return self.image
+
+    def crop(self, box, width, height):
+        # Returns the part box (x0, y0, x1, y1) of the layer drawn at
+        # width x height, images are only drawn at their own size. The
+        # whole image is returned without a copy.
+        if self.gradient is not None:
+            return render_gradient(self.gradient, width, height, box)
+        if tuple(box) == (0, 0, width, height):
+            return self.getImage()
+        return self.getImage().crop(box)
+
+
+class LayerRasterCache():
+    # The prepared pixels of layers, see transform_layer, shared by the
+    # strips of one output image. Pixels are only kept while they fit
+    # in limit bytes.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.rasters = {}
+
+    def fits(self, key, size):
+        return key in self.rasters or self.used + size <= self.limit
+
+    def get(self, key):
+        return self.rasters.get(key)
+
+    def add(self, key, raster, size):
+        self.rasters[key] = raster
+        self.used += size
+
+
+def composite_layers(layers, width, height, scale=1, box=None,
+                     background=(255, 255, 255, 255), cache=None):
+    # Composite a stack of layers into an image of the width x height
+    # canvas enlarged by scale, without drawing a graphics scene.
+    # layers are (CanvasLayerSource, transform) pairs from the bottom
+    # up, see ImageLayer.getCanvasTransform. Only the pixels inside box
+    # (x0, y0, x1, y1) of the output are produced, so a tile of a
+    # large output can be rendered on its own. The layers are drawn
+    # with a QPainter on a QImage, which is safe off the interface
+    # thread. cache is a LayerRasterCache shared by the tiles of one
+    # output so each layer is prepared once.
+    if box is None:
+        box = (0, 0, round(width * scale), round(height * scale))
+    x0, y0, x1, y1 = box
+    output = qtg.QImage(x1 - x0, y1 - y0,
+                        qtg.QImage.Format_ARGB32_Premultiplied)
+    output.fill(qtg.QColor(*background))
+    painter = qtg.QPainter(output)
+    painter.setRenderHints(qtg.QPainter.Antialiasing |
+                           qtg.QPainter.SmoothPixmapTransform)
+
+    for source, transform in layers:
+        # The transform from the layer into the output pixels
+        a, b, c, d, e, f = [value * scale for value in transform]
+        placed = transform_layer(source, (a, b, c - x0, d, e, f - y0),
+                                 (x1 - x0, y1 - y0), cache)
+        if placed is not None:
+            pixels, layer_transform = placed
+            painter.setTransform(layer_transform)
+            painter.drawImage(0, 0, pixels)
+
+    painter.end()
+    return convertQImageToImage(output)
+
+
+def premultiply_alpha(image):
+    # Returns an RGBa copy of an image for resampling
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA")
+    return image.convert("RGBa")
+
+
+def prepare_layer_pixels(image, reduction):
+    # Returns a premultiplied QImage of a layer's pixels, box filtered
+    # down by reduction. Pixels are premultiplied before they are
+    # reduced so the transparent pixels around an image do not darken
+    # its edges.
+    if reduction > 1:
+        image = premultiply_alpha(image).reduce(reduction)
+        data = image.tobytes("raw", "RGBa")
+        image_format = qtg.QImage.Format_RGBA8888_Premultiplied
+    else:
+        if image.mode != "RGBA":
+            image = image.convert("RGBA")
+        data = image.tobytes("raw", "RGBA")
+        image_format = qtg.QImage.Format_RGBA8888
+    qimage = qtg.QImage(data, image.width, image.height, image.width * 4,
+                        image_format)
+    return qimage.convertToFormat(qtg.QImage.Format_ARGB32_Premultiplied)
+
+
+def transform_layer(source, transform, size, cache=None):
+    # Returns the prepared pixels of a layer (a CanvasLayerSource) and
+    # the QTransform that draws them onto an output of the given size,
+    # or None if the layer is outside the output. Large reductions are
+    # box filtered first, the bilinear filter alone would skip most of
+    # the image's pixels. The whole layer is prepared once and kept in
+    # cache when it fits, otherwise only the part of it under the
+    # output is prepared.
+    a, b, c, d, e, f = transform
+    width, height = size
+    image_width, image_height = source.getSize()
+    if source.isParametric():
+        # A gradient is rendered at the size it is drawn in the output
+        # and the transform is changed to place that rendering.
+        render_width = max(1, math.floor(image_width * math.hypot(a, d) + 0.5))
+        render_height = max(1, math.floor(image_height * math.hypot(b, e) + 0.5))
+        a, d = a * image_width / render_width, d * image_width / render_width
+        b, e = b * image_height / render_height, e * image_height / render_height
+        image_width, image_height = render_width, render_height
+
+    if abs(b) < 1e-9 and abs(d) < 1e-9 and a > 0 and e > 0:
+        # A layer that is only moved and scaled is placed on whole
+        # output pixels. Halves are always rounded up and the size is
+        # rounded on its own so the layer is placed the same in every
+        # tile.
+        placed_width = math.floor(a * image_width + 0.5)
+        placed_height = math.floor(e * image_height + 0.5)
+        if placed_width < 1 or placed_height < 1:
+            return None
+        b = d = 0
+        a, c = placed_width / image_width, math.floor(c + 0.5)
+        e, f = placed_height / image_height, math.floor(f + 0.5)
+
+    determinant = a * e - b * d
+    if abs(determinant) < 1e-9:
+        return None
+    # The part of the output covered by the layer
+    corners = [(a * x + b * y + c, d * x + e * y + f)
+               for x in (0, image_width) for y in (0, image_height)]
+    left = max(math.floor(min(x for x, y in corners)), 0)
+    top = max(math.floor(min(y for x, y in corners)), 0)
+    right = min(math.ceil(max(x for x, y in corners)), width)
+    bottom = min(math.ceil(max(y for x, y in corners)), height)
+    if left >= right or top >= bottom:
+        return None
+
+    reduction = max(1, min(int(1 / math.sqrt(abs(determinant))),
+                           image_width, image_height))
+    key = (source, image_width, image_height, reduction)
+    raster_size = (math.ceil(image_width / reduction) *
+                   math.ceil(image_height / reduction) * 4)
+    if cache is not None and cache.fits(key, raster_size):
+        crop = (0, 0)
+        pixels = cache.get(key)
+        if pixels is None:
+            pixels = prepare_layer_pixels(
+                source.crop((0, 0, image_width, image_height),
+                            image_width, image_height), reduction)
+            cache.add(key, pixels, raster_size)
+    else:
+        # Each corner of the covered output is mapped back into the
+        # image to find the part of it that is needed
+        inverse = [e / determinant, -b / determinant,
+                   -d / determinant, a / determinant]
+        sources = [(inverse[0] * (x - c) + inverse[1] * (y - f),
+                    inverse[2] * (x - c) + inverse[3] * (y - f))
+                   for x in (left, right) for y in (top, bottom)]
+        margin = 4 * reduction
+        crop = [max(math.floor(min(x for x, y in sources)) - margin, 0),
+                max(math.floor(min(y for x, y in sources)) - margin, 0),
+                min(math.ceil(max(x for x, y in sources)) + margin,
+                    image_width),
+                min(math.ceil(max(y for x, y in sources)) + margin,
+                    image_height)]
+        if crop[0] >= crop[2] or crop[1] >= crop[3]:
+            return None
+        # The crop starts on a multiple of the reduction so tiles of an
+        # output reduce the image in the same blocks.
+        crop[0] -= crop[0] % reduction
+        crop[1] -= crop[1] % reduction
+        pixels = prepare_layer_pixels(
+            source.crop(crop, image_width, image_height), reduction)
+
+    # Each prepared pixel covers reduction x reduction image pixels
+    # from the corner of the crop
+    return pixels, qtg.QTransform(
+        a * reduction, d * reduction, b * reduction, e * reduction,
+        a * crop[0] + b * crop[1] + c, d * crop[0] + e * crop[1] + f)
 
 
 if __name__ == '__main__':
     app = qtw.QApplication(sys.argv)
+    app.aboutToQuit.connect(BackgroundTask.cancelAll)
 
     # Create a project directory
     shutil.rmtree(project_path, ignore_errors=True)
@@ -4677,4 +7491,6 @@ if __name__ == '__main__':
     app.processEvents()
     mw = MainWindow()
     splash_screen.finish(mw)
+    if pixel_cache_limit > 0:
+        BackgroundTask(pixel_cache_evict_task).start(priority=-1)
     sys.exit(app.exec())
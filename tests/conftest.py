@@ -0,0 +1,27 @@
+# Loads the application with an offscreen Qt platform for the tests
+import importlib.util
+import os
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5 import QtWidgets as qtw
+
+REPO = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def dcc(tmp_path_factory):
+    os.chdir(tmp_path_factory.mktemp("work"))
+    app = qtw.QApplication.instance() or qtw.QApplication([])
+    spec = importlib.util.spec_from_file_location(
+        "dcc", REPO / "Digital Collage Creator.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.project_path.mkdir(parents=True, exist_ok=True)
+    module.pixel_cache_limit = 0
+    module.mw = module.MainWindow()
+    yield module
+    module.BackgroundTask.cancelAll()
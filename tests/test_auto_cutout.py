@@ -0,0 +1,22 @@
+# A cutout seed covering the whole image must still give a mask rather
+# than a GrabCut error.
+import numpy as np
+
+
+class Task():
+    def checkCancelled(self):
+        pass
+
+    def setProgress(self, percent):
+        pass
+
+
+def test_seed_box_past_image_edges(dcc):
+    image = np.zeros((300, 400, 4), dtype=np.uint8)
+    image[..., 3] = 255
+    image[..., :3] = (30, 60, 200)
+    image[80:220, 120:280, :3] = (220, 200, 40)
+    mask = dcc.auto_cutout_mask(Task(), image, (-20, -20, 450, 350), None)
+    assert mask.shape == (300, 400)
+    assert mask[150, 200] == 255
+    assert mask[10, 10] == 0
@@ -0,0 +1,49 @@
+# The canvas preview stored with a project shows only the layers, not
+# the handles and borders of the scene, and is shown while the project
+# opens.
+from PIL import Image
+
+
+def create_layer(dcc):
+    image_name = "preview_" + str(dcc.LayerManager.num_layers) + ".png"
+    Image.new("RGBA", (300, 200), (200, 40, 40, 255)).save(
+        str(dcc.project_path / image_name))
+    return dcc.LayerManager.createNewLayer(
+        image_name, "layer", dcc.LayerManager.num_layers, 0, 0)
+
+
+def test_canvas_preview_only_draws_layers(dcc):
+    layer = create_layer(dcc)
+    dcc.mw.addLayers([layer])
+    layer.enableRotate()
+    preview = dcc.mw.renderCanvasPreview()
+    layer.disableAll()
+
+    # The layer is drawn, the canvas border and background are not
+    scale = preview.width / dcc.Canvas.width()
+    centre = layer.getLayerItem().sceneBoundingRect().center()
+    red, green, _, alpha = preview.getpixel((round(centre.x() * scale),
+                                             round(centre.y() * scale)))
+    assert alpha == 255 and red > 150 and green < 100
+    assert preview.getpixel((preview.width - 1, preview.height - 1))[3] == 0
+
+
+def test_canvas_preview_shown_while_opening(dcc, tmp_path, monkeypatch):
+    dcc.mw.addLayers([create_layer(dcc)])
+    file_name = str(tmp_path / "preview.dcc")
+    dcc.mw.saveProject(file_name)
+
+    shown = []
+    show = dcc.mw.showCanvasPreview
+
+    def record(preview_bytes):
+        item = show(preview_bytes)
+        shown.append(item)
+        return item
+
+    monkeypatch.setattr(dcc.mw, "showCanvasPreview", record)
+    dcc.mw.openProjectDialog = lambda: file_name
+    dcc.mw.openProjectSubmit()
+
+    assert len(shown) == 1
+    assert shown[0].scene() is None
@@ -0,0 +1,45 @@
+# Exports composite the layers a strip at a time, reusing each layer's
+# prepared pixels across the strips.
+import numpy as np
+from PIL import Image
+
+
+def create_source(dcc, width, height):
+    pixels = np.random.default_rng(0).integers(
+        0, 256, (height, width, 4), dtype=np.uint8)
+    pixels[..., 3] = 255
+    pixels[:, :width // 4, 3] = 0
+    image = Image.fromarray(pixels, "RGBA")
+    return dcc.CanvasLayerSource(image.size, image=image)
+
+
+def composite_strips(dcc, layers, scale, cache):
+    output = Image.new("RGBA", (round(200 * scale), round(300 * scale)))
+    for top in range(0, output.height, 64):
+        box = (0, top, output.width, min(top + 64, output.height))
+        output.paste(dcc.composite_layers(layers, 200, 300, scale, box,
+                                          cache=cache), box[:2])
+    return np.asarray(output)
+
+
+def test_strips_match_full_composite(dcc):
+    # A moved and scaled layer is placed on whole pixels in every strip
+    layers = [(create_source(dcc, 400, 300), (0.3, 0, 20.5, 0, 0.3, 40.25))]
+    full = np.asarray(dcc.composite_layers(layers, 200, 300, 2.5))
+    cache = dcc.LayerRasterCache(dcc.export_cache_limit)
+
+    assert np.array_equal(composite_strips(dcc, layers, 2.5, cache), full)
+    assert len(cache.rasters) == 1
+
+
+def test_cached_pixels_match_strip_crops(dcc):
+    # A rotated, reduced layer over the cache limit is prepared from the
+    # part under each strip. Only the antialiased edges of the layer,
+    # drawn from the crop's corners, may differ slightly.
+    source = create_source(dcc, 1200, 900)
+    layers = [(source, (0.1, -0.06, 80, 0.06, 0.1, 20))]
+    cached = composite_strips(
+        dcc, layers, 1.5, dcc.LayerRasterCache(dcc.export_cache_limit))
+    cropped = composite_strips(dcc, layers, 1.5, dcc.LayerRasterCache(0))
+
+    assert np.abs(cached.astype(int) - cropped).max() <= 4
@@ -0,0 +1,28 @@
+# Choosing a colour after the gradient colour rows are rebuilt must not
+# touch the labels of the previous rows.
+from PyQt5 import QtCore as qtc
+
+
+def colour_labels(dcc, row):
+    grid = dcc.mw.gradient_grid
+    return [grid.itemAtPosition(row, column).widget()
+            for column in range(1, grid.columnCount())
+            if grid.itemAtPosition(row, column) is not None]
+
+
+def delete_removed_widgets():
+    qtc.QCoreApplication.sendPostedEvents(None, qtc.QEvent.DeferredDelete)
+
+
+def test_choose_colour_after_rebuild(dcc):
+    dcc.mw.populateGradientColours(["#102030", "#405060"])
+    colour_labels(dcc, 0)[0].mousePressEvent(None)
+    colour_labels(dcc, 1)[1].mousePressEvent(None)
+
+    dcc.mw.populateGradientColours(["#102030", "#405060"])
+    delete_removed_widgets()
+
+    colour_labels(dcc, 0)[1].mousePressEvent(None)
+    colour_labels(dcc, 1)[0].mousePressEvent(None)
+    assert dcc.GradientManager.getActiveColour(1) == "(64, 80, 96)"
+    assert dcc.GradientManager.getActiveColour(2) == "(16, 32, 48)"
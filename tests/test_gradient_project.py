@@ -0,0 +1,23 @@
+# A cut gradient layer must open from a project with its cut.
+import numpy as np
+from PIL import Image
+
+
+def test_cut_gradient_reopens_with_mask(dcc, tmp_path):
+    dcc.mw.gradientGenerate()
+    layer = dcc.LayerManager.layers_container[-1]
+    mask = Image.new("L", layer.getCroppedImage().size, 255)
+    mask.paste(0, (0, 0, mask.width // 2, mask.height))
+    layer.setMask(mask)
+    layer.compositeMask()
+    alpha = np.asarray(layer.getDisplayImage().getchannel("A")).mean()
+
+    file_name = str(tmp_path / "gradient.dcc")
+    dcc.mw.saveProject(file_name)
+    count = len(dcc.LayerManager.layers_container)
+    dcc.mw.openProjectDialog = lambda: file_name
+    dcc.mw.openProjectSubmit()
+
+    opened = dcc.LayerManager.layers_container[count:][-1]
+    assert isinstance(opened, dcc.GradientLayer) and opened.isParametric()
+    assert np.asarray(opened.getDisplayImage().getchannel("A")).mean() == alpha
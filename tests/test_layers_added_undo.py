@@ -0,0 +1,27 @@
+# Redoing the addition of several layers, such as those of an opened
+# project, must keep hidden layers hidden.
+from PIL import Image
+
+
+def create_layer(dcc):
+    image_name = "added_" + str(dcc.LayerManager.num_layers) + ".png"
+    Image.new("RGBA", (60, 40), (40, 200, 40, 255)).save(
+        str(dcc.project_path / image_name))
+    return dcc.LayerManager.createNewLayer(
+        image_name, "layer", dcc.LayerManager.num_layers, 0, 0)
+
+
+def test_redo_layers_added_keeps_visibility(dcc):
+    layers = [create_layer(dcc), create_layer(dcc)]
+    dcc.mw.addLayers(layers)
+    layers[1].getLayerWidget().turnVisibleOff()
+
+    dcc.ActionManager.undoClick()
+    assert not any(layer in dcc.LayerManager.layers_container
+                   for layer in layers)
+    dcc.ActionManager.redoClick()
+
+    assert all(layer in dcc.LayerManager.layers_container for layer in layers)
+    assert layers[0].getLayerItem().isVisible()
+    assert not layers[1].getLayerItem().isVisible()
+    assert not layers[1].getLayerWidget().is_layer_visible
@@ -0,0 +1,50 @@
+# Undoing and redoing points of the cutout path must keep the closed
+# sub-paths, otherwise holes cut with the odd-even rule are filled.
+from PyQt5 import QtCore as qtc
+from PIL import Image
+
+
+def open_cutout_window(dcc):
+    image_name = "path_layer.png"
+    Image.new("RGBA", (100, 100), (40, 40, 200, 255)).save(
+        str(dcc.project_path / image_name))
+    layer = dcc.LayerManager.createNewLayer(
+        image_name, "layer", dcc.LayerManager.num_layers, 0, 0)
+    dcc.mw.addLayer(layer)
+    dcc.LayerManager.setActiveLayer(layer)
+    dcc.mw.cutoutSubmit()
+    return dcc.mw.cutout_window.getPointManager()
+
+
+def plot_square(point_manager, x0, y0, x1, y1):
+    for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1)):
+        point_manager.addPoint(x, y)
+    point_manager.closePath()
+
+
+def rasterize(dcc, point_manager):
+    return dcc.rasterizePaths(point_manager.getSubPaths(), 100, 100,
+                              qtc.Qt.OddEvenFill)
+
+
+def test_redo_closes_reopened_sub_paths(dcc):
+    point_manager = open_cutout_window(dcc)
+    plot_square(point_manager, 10, 10, 90, 90)
+    plot_square(point_manager, 40, 40, 60, 60)
+    paths = point_manager.getSubPaths()
+    mask = rasterize(dcc, point_manager)
+    assert not mask[50, 50] and mask[20, 20]
+
+    # Undo the inner square and the point closing the outer one,
+    # then redo them.
+    for _ in range(6):
+        point_manager.undo()
+    assert point_manager.closed_paths == []
+    assert len(point_manager.points) == 4
+    for _ in range(6):
+        point_manager.redo()
+
+    assert len(point_manager.closed_paths) == 2
+    assert point_manager.points == []
+    assert point_manager.getSubPaths() == paths
+    assert (rasterize(dcc, point_manager) == mask).all()
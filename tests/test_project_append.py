@@ -0,0 +1,43 @@
+# Saving again to a project appends to it in place, a save that fails
+# part way must leave the file as it was.
+import zipfile
+from functools import partial
+
+import pytest
+
+
+def write_archive(dcc, file_name, names, append):
+    entries = {name: partial(dcc.writeBytesEntry, entry_name=name,
+                             data=name.encode() * 1000)
+               for name in names}
+    dcc.writeProjectArchive(file_name, {'layers': []}, entries, append)
+
+
+def test_append_adds_manifest_in_place(dcc, tmp_path):
+    file_name = str(tmp_path / "append.dcc")
+    write_archive(dcc, file_name, ["images/a"], False)
+    write_archive(dcc, file_name, ["images/a", "images/b"], True)
+
+    with zipfile.ZipFile(file_name) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == ["images/a", "manifests/1.json",
+                                      "images/b", "manifests/2.json"]
+
+
+def test_failed_append_restores_file(dcc, tmp_path):
+    file_name = str(tmp_path / "failed.dcc")
+    write_archive(dcc, file_name, ["images/a"], False)
+    with open(file_name, "rb") as project_file:
+        before = project_file.read()
+
+    def fail(archive):
+        raise RuntimeError("write failed")
+
+    entries = {"images/a": None, "images/b": partial(
+        dcc.writeBytesEntry, entry_name="images/b", data=b"b" * 1000),
+        "images/c": fail}
+    with pytest.raises(RuntimeError):
+        dcc.writeProjectArchive(file_name, {'layers': []}, entries, True)
+
+    with open(file_name, "rb") as project_file:
+        assert project_file.read() == before
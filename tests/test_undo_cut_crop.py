@@ -0,0 +1,59 @@
+# Undoing cuts and crops of a rotated, scaled layer must put back masks
+# that match the layer image at every step.
+import pytest
+from PyQt5 import QtCore as qtc
+from PIL import Image
+
+
+def add_layer(dcc):
+    image_name = "layer_" + str(dcc.LayerManager.num_layers) + ".png"
+    Image.new("RGBA", (120, 80), (200, 40, 40, 255)).save(
+        str(dcc.project_path / image_name))
+    dcc.mw.addLayer(dcc.LayerManager.createNewLayer(
+        image_name, "layer", dcc.LayerManager.num_layers, 0, 0))
+    layer = dcc.LayerManager.layers_container[-1]
+    layer.getLayerItem().setRotation(30)
+    layer.getLayerItem().setScale(0.5)
+    return layer
+
+
+def cut(dcc, layer):
+    # Cut away the left half of the layer image
+    pre_cut_mask = layer.getMask()
+    mask = Image.new("L", layer.getCroppedImage().size, 255)
+    mask.paste(0, (0, 0, mask.width // 2, mask.height))
+    layer.setMask(mask)
+    layer.compositeMask()
+    dcc.ActionManager.layerCut(layer, pre_cut_mask, mask)
+
+
+def crop(layer):
+    layer.crop(10, 10, 50, 40, qtc.QPointF(5, 5))
+
+
+def assert_mask_matches(layer):
+    mask = layer.getMask()
+    assert mask is None or mask.size == layer.getCroppedImage().size
+    assert layer.getDisplayImage().size == layer.getCroppedImage().size
+
+
+@pytest.mark.parametrize("first, second", [(crop, cut), (cut, crop)],
+                         ids=["crop-cut", "cut-crop"])
+def test_undo_redo_cut_and_crop(dcc, first, second):
+    layer = add_layer(dcc)
+    image_size = layer.getCroppedImage().size
+    for edit in (first, second):
+        edit(dcc, layer) if edit is cut else edit(layer)
+        assert_mask_matches(layer)
+
+    for _ in range(2):
+        dcc.ActionManager.undoClick()
+        assert_mask_matches(layer)
+    assert layer.getCroppedImage().size == image_size
+    assert layer.getLayerItem().getRotation() == 30
+    assert layer.getLayerItem().getScale() == 0.5
+
+    for _ in range(2):
+        dcc.ActionManager.redoClick()
+        assert_mask_matches(layer)
+    assert layer.getLayerItem().getRotation() == 0